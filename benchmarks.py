@@ -0,0 +1,276 @@
+"""Benchmarks for filesystem_tree.
+
+Run the suite and save the results::
+
+    $ python benchmarks.py run --sizes 10,100,1000,10000 --output before.json
+
+Run it against another revision of ``filesystem_tree.py`` from git (the
+benchmarks themselves always come from the working tree)::
+
+    $ python benchmarks.py run --rev HEAD~3 --output after.json
+
+Compare two result files::
+
+    $ python benchmarks.py compare before.json after.json
+
+Compare the deletion engine behind :py:func:`FilesystemTree.remove` with
+:py:func:`shutil.rmtree`::
+
+    $ python benchmarks.py rmtree --sizes 10000
+
+Each case is timed ``--repeat`` times for each size, with setup and teardown
+outside the timing, and the result files record the fastest and median
+timings along with the Python version, platform, and revision. The cases only
+use the oldest parts of the API, so any revision can be benchmarked.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Tree shapes
+# ===========
+# Each takes a number of entries and returns a treedef.
+
+def wide(n):
+    """``n`` small files in one directory.
+    """
+    return [('file%d.txt' % i, 'Greetings, program!') for i in range(n)]
+
+
+def bushy(n, fanout=10):
+    """``n`` small files spread over nested directories, ``fanout`` to a level.
+    """
+    treedef = []
+    for i in range(n):
+        parts, j = [], i // fanout
+        while j:
+            parts.append('d%d' % (j % fanout))
+            j //= fanout
+        treedef.append(('/'.join(parts + ['file%d.txt' % i]), 'Greetings, program!'))
+    return treedef
+
+
+def deep(n, depth=64):
+    """``n`` small files along a single chain of directories ``depth`` deep.
+    """
+    return [('/'.join(['d'] * (i % depth) + ['file%d.txt' % i]), 'Greetings, program!') for i in range(n)]
+
+
+def huge(n, count=4):
+    """``count`` files with ``n`` KiB of contents between them.
+    """
+    body = 'x' * (1024 * max(1, n // count))
+    return [('file%d.bin' % i, body, False) for i in range(count)]
+
+
+# Cases
+# =====
+# Each takes the filesystem_tree module under test and a size, and returns
+# (setup, run, teardown) functions. setup's return value is passed to run and
+# teardown.
+
+def case_init(ft, n):
+    trees = []
+    def run(_):
+        for i in range(n):
+            trees.append(ft.FilesystemTree())
+    def teardown(_):
+        while trees:
+            trees.pop().remove()
+    return (lambda: None), run, teardown
+
+
+def mk_case(shape):
+    def case(ft, n):
+        treedef = shape(n)
+        return ft.FilesystemTree, (lambda tree: tree.mk(*treedef)), (lambda tree: tree.remove())
+    case.__doc__ = 'mk() a treedef of shape {0}'.format(shape.__name__)
+    return case
+
+
+def case_resolve(ft, n):
+    treedef = bushy(n)
+    paths = [path for path, _ in treedef]
+    def run(tree):
+        for path in paths:
+            tree.resolve(path)
+    return (lambda: ft.FilesystemTree(*treedef)), run, (lambda tree: tree.remove())
+
+
+def case_remove(ft, n):
+    treedef = bushy(n)
+    return (lambda: ft.FilesystemTree(*treedef)), (lambda tree: tree.remove()), (lambda tree: None)
+
+
+CASES = [ ('init', case_init)
+        , ('mk-small', mk_case(bushy))
+        , ('mk-huge', mk_case(huge))
+        , ('mk-deep', mk_case(deep))
+        , ('mk-wide', mk_case(wide))
+        , ('resolve', case_resolve)
+        , ('remove', case_remove)
+         ]
+
+
+# Running
+# =======
+
+def time_case(case, ft, n, repeat):
+    """Return the timings of ``repeat`` runs of ``case`` at size ``n``.
+    """
+    timings = []
+    for i in range(repeat):
+        setup, run, teardown = case(ft, n)
+        arg = setup()
+        start = time.time()
+        try:
+            run(arg)
+            timings.append(time.time() - start)
+        finally:
+            teardown(arg)
+    return timings
+
+
+def load_module(rev):
+    """Return the filesystem_tree module from the working tree, or from git
+    revision ``rev``.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    if rev is None:
+        sys.path.insert(0, here)
+        import filesystem_tree
+        return filesystem_tree
+    source = subprocess.check_output(['git', 'show', rev + ':filesystem_tree.py'], cwd=here)
+    tmp = tempfile.mkdtemp(prefix='filesystem-tree-bench-')
+    try:
+        path = os.path.join(tmp, 'filesystem_tree.py')
+        with open(path, 'wb') as f:
+            f.write(source)
+        return load_source('filesystem_tree_at_' + rev.replace('~', '_').replace('^', '_'), path)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def load_source(name, path):
+    try:
+        import importlib.util
+    except ImportError:  # Python 2
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def describe(rev):
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', rev or 'HEAD'], cwd=here)
+    except (OSError, subprocess.CalledProcessError):
+        return rev
+    commit = out.decode('ascii').strip()
+    return commit if rev else commit + ' (working tree)'
+
+
+def run(args):
+    ft = load_module(args.rev)
+    cases = [(name, case) for name, case in CASES if not args.cases or name in args.cases]
+    results = { 'revision': describe(args.rev)
+              , 'python': platform.python_version()
+              , 'platform': platform.platform()
+              , 'repeat': args.repeat
+              , 'results': {}
+               }
+    for name, case in cases:
+        for n in args.sizes:
+            timings = time_case(case, ft, n, args.repeat)
+            key = '{0}/{1}'.format(name, n)
+            results['results'][key] = {'min': min(timings), 'median': sorted(timings)[len(timings) // 2]}
+            print('{0:>20}  {1:.6f}s'.format(key, min(timings)))
+            sys.stdout.flush()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print('before: {0}\nafter:  {1}\n'.format(before['revision'], after['revision']))
+    print('{0:>20}  {1:>12}  {2:>12}  {3:>8}'.format('case', 'before', 'after', 'speedup'))
+    for key in sorted(set(before['results']) & set(after['results']), key=sort_key):
+        a, b = before['results'][key]['min'], after['results'][key]['min']
+        print('{0:>20}  {1:>11.6f}s  {2:>11.6f}s  {3:>7.2f}x'.format(key, a, b, a / b if b else float('inf')))
+
+
+def sort_key(key):
+    name, n = key.rsplit('/', 1)
+    return name, int(n)
+
+
+def rmtree(args):
+    ft = load_module(None)
+    engines = [ ('shutil.rmtree', shutil.rmtree)
+              , ('_rmtree', ft._rmtree)
+              , ('_rmtree with 4 workers', lambda root: ft._rmtree(root, workers=4))
+               ]
+    for shape in (wide, bushy):
+        for n in args.sizes:
+            treedef = shape(n)
+            timings = []
+            for name, engine in engines:
+                case = lambda fs, n: ((lambda: fs.FilesystemTree(*treedef).root), engine, (lambda root: None))
+                timings.append((name, min(time_case(case, ft, n, args.repeat))))
+            baseline = timings[0][1]
+            print('remove {0:>6} {1:>8} files: {2}'.format(shape.__name__, n, ', '.join(
+                '{0} {1:.3f}s ({2:.2f}x)'.format(name, t, baseline / t) for name, t in timings)))
+
+
+def main(argv=None):
+    sizes = lambda s: [int(n) for n in s.split(',')]
+    parser = argparse.ArgumentParser(description='Benchmark filesystem_tree.')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('run', help='run the benchmark suite')
+    p.add_argument('--sizes', type=sizes, default=[10, 100, 1000, 10000],
+                   help='comma-separated numbers of entries, up to 1000000 (default: 10,100,1000,10000)')
+    p.add_argument('--repeat', type=int, default=3, help='how many times to time each case (default: 3)')
+    p.add_argument('--cases', type=lambda s: s.split(','),
+                   help='comma-separated cases to run (default: all of {0})'.format(
+                       ','.join(name for name, _ in CASES)))
+    p.add_argument('--rev', help='a git revision of filesystem_tree.py to benchmark (default: the working tree)')
+    p.add_argument('--output', help='a file to save the results to, as JSON')
+    p.set_defaults(func=run)
+
+    p = commands.add_parser('compare', help='compare two result files')
+    p.add_argument('before')
+    p.add_argument('after')
+    p.set_defaults(func=compare)
+
+    p = commands.add_parser('rmtree', help='compare the deletion engine with shutil.rmtree')
+    p.add_argument('--sizes', type=sizes, default=[10000])
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=rmtree)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'func', None) is None:
+        parser.print_help()
+        return 2
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
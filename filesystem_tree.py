@@ -20,6 +20,20 @@ Make directories like so:
 
 >>> ft.mk('my/directory/')
 
+If you build the same tree over and over,
+:py:func:`~filesystem_tree.compile_treedef` saves redoing the parsing and
+encoding each time:
+
+>>> from filesystem_tree import compile_treedef
+>>> plan = compile_treedef(('greetings/program.txt', 'Greetings, program!'))
+>>> ft.mk(plan)
+
+If you need the same tree over and over, build it once and
+:py:func:`~filesystem_tree.FilesystemTree.clone` it:
+
+>>> copy = ft.clone()
+>>> copy.remove()
+
 When you're done, clean up with :py:func:`~filesystem_tree.FilesystemTree.remove`:
 
 >>> ft.remove()
@@ -29,19 +43,42 @@ Or use it as a context manager to clean up automatically:
 >>> with FilesystemTree() as ft:
 ...     ft.mk('my/stuff')
 
+From :py:mod:`asyncio` code, use
+:py:func:`~filesystem_tree.FilesystemTree.amk`,
+:py:func:`~filesystem_tree.FilesystemTree.aremove`, and ``async with`` to keep
+the event loop running while the disk does its work.
+
 
 API Reference
 =============
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import atexit
+import binascii
+import codecs
+import collections
+import errno
+import fnmatch
+import hashlib
+import io
+import itertools
+import mmap
 import os
+import posixpath
+import random
 import shutil
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+import zipfile
+from functools import partial
+from stat import S_IFDIR, S_IFREG, S_ISDIR
 from textwrap import dedent
 
-from os.path import dirname, isdir, realpath
+from os.path import dirname, isdir, islink, realpath
 
 
 __version__ = '1.1.2-dev'
@@ -54,6 +91,1131 @@ else:
     is_stringy = lambda s: isinstance(s, basestring)
     is_bytestring = lambda s: isinstance(s, str)
 
+is_buffer = lambda s: isinstance(s, (bytearray, memoryview, mmap.mmap))
+
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    import asyncio
+except ImportError:  # Python < 3.4
+    asyncio = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+FICLONE = 0x40049409    # from linux/fs.h; clones a whole file on btrfs, xfs, etc.
+
+
+def _makedirs(path, dir_fd=None):
+    """Like :py:func:`os.makedirs`, but don't mind if ``path`` already exists,
+    and return how many directories were made. A relative ``path`` may be
+    given relative to the directory open at ``dir_fd``.
+    """
+    mkdir = os.mkdir if dir_fd is None else partial(os.mkdir, dir_fd=dir_fd)
+    made = 0
+    try:
+        mkdir(path)
+        return 1
+    except OSError as exc:
+        if exc.errno == errno.ENOENT and dirname(path) not in ('', path):
+            made = _makedirs(dirname(path), dir_fd)
+        elif exc.errno != errno.EEXIST or not _isdir(path, dir_fd):
+            raise
+        else:
+            return 0
+    try:
+        mkdir(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST or not _isdir(path, dir_fd):
+            raise
+        return made
+    return made + 1
+
+
+def _isdir(path, dir_fd=None):
+    """Like :py:func:`os.path.isdir`, but a relative ``path`` may be given
+    relative to the directory open at ``dir_fd``.
+    """
+    if dir_fd is None:
+        return isdir(path)
+    try:
+        return S_ISDIR(os.stat(path, dir_fd=dir_fd).st_mode)
+    except OSError:
+        return False
+
+
+_dir_fds_supported = ( hasattr(os, 'supports_dir_fd')
+                   and set([os.open, os.mkdir, os.stat]) <= os.supports_dir_fd
+                    )
+
+_O_WRITE = os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+
+
+def _create(path, dir_fd=None):
+    """Open the file at ``path`` (relative to the directory open at
+    ``dir_fd``, if given) for writing, emptying it, and return the file and
+    whether it had to be created.
+    """
+    kw = {} if dir_fd is None else {'dir_fd': dir_fd}
+    try:
+        fd = os.open(path, _O_WRITE | os.O_EXCL, 0o666, **kw)
+        created = True
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+        fd = os.open(path, _O_WRITE, 0o666, **kw)
+        created = False
+    return io.open(fd, 'wb+'), created
+
+
+def _close_dir_fds(root_fd, subdir_fds):
+    """Close the descriptors a :py:class:`FilesystemTree` keeps for its
+    directories.
+    """
+    for fd in [root_fd] + list(subdir_fds.values()):
+        if fd < 0:
+            continue
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    subdir_fds.clear()
+
+
+class _Journal(collections.OrderedDict):
+    """An ordered set of paths, oldest first, where adding a path again
+    makes it the newest.
+    """
+
+    def append(self, path):
+        self.pop(path, None)
+        self[path] = None
+
+    def extend(self, paths):
+        for path in paths:
+            self.append(path)
+
+
+def _parse_treedef(treedef, should_dedent, encoding, sep):
+    """Validate ``treedef`` before any I/O, returning ``(dirs, files)``.
+
+    Paths come back relative to the root, using ``sep`` as the separator
+    (directories without a trailing one), and files come back as ``(path,
+    contents, should_dedent, encoding)``. Any :py:class:`Plan` in
+    ``treedef`` is spliced in as it is.
+
+    """
+    convert_path = lambda path: sep.join(path.lstrip('/').split('/'))
+    dirs, files = [], []
+
+    for item in treedef:
+        if is_stringy(item):
+            dirs.append(convert_path(item.rstrip('/')))
+        elif isinstance(item, Plan):
+            if sep == '/':
+                dirs.extend(item.dirs)
+                files.extend(item.files)
+            else:
+                dirs.extend(sep.join(path.split('/')) for path in item.dirs)
+                files.extend((sep.join(f[0].split('/')),) + f[1:] for f in item.files)
+        elif isinstance(item, tuple):
+
+            if len(item) == 2:
+                filepath, contents = item
+                files.append((convert_path(filepath), contents, should_dedent, encoding))
+            elif len(item) == 3:
+                filepath, contents, _should_dedent = item
+                files.append((convert_path(filepath), contents, _should_dedent, encoding))
+            elif len(item) == 4:
+                filepath, contents, _should_dedent, _encoding = item
+                files.append((convert_path(filepath), contents, _should_dedent, _encoding))
+            else:
+                raise ValueError
+
+            contents = files[-1][1]
+            if not (_is_text(contents) or _is_raw(contents) or _is_streamed(contents)):
+                raise TypeError
+
+        else:
+            raise TypeError
+
+    return dirs, files
+
+
+def _encode(contents, should_dedent, encoding):
+    """Turn file contents from a treedef into the bytestring to write.
+    """
+    if should_dedent:
+        contents = dedent(contents)
+
+    if not is_bytestring(contents):
+        contents = contents.encode(encoding)
+
+    return contents
+
+
+def _digest(contents):
+    """Return a hash of bytestring or buffer ``contents``, or ``None`` for
+    anything else.
+    """
+    if is_bytestring(contents) or is_buffer(contents):
+        return getattr(hashlib, 'blake2b', hashlib.sha1)(contents).digest()
+    return None
+
+
+def _file_digest(path, chunk_size):
+    """Return the hash :py:func:`_digest` would give the contents of the file
+    at ``path``, reading it ``chunk_size`` bytes at a time.
+    """
+    h = getattr(hashlib, 'blake2b', hashlib.sha1)()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.digest()
+
+
+def _blob_record(st):
+    """Return what :py:class:`FilesystemTree` remembers about a blob it wrote,
+    from its ``os.stat`` result ``st``.
+    """
+    return (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino)
+
+
+def _is_text(contents):
+    """Return whether ``contents`` is a string for :py:func:`_encode` to prepare.
+    """
+    return is_stringy(contents) or is_bytestring(contents)
+
+
+def _is_raw(contents):
+    """Return whether ``contents`` are bytes to write as they are, without
+    dedenting, encoding, or copying them into Python first.
+    """
+    return is_buffer(contents) or isinstance(contents, (Source, Sized))
+
+
+def _is_streamed(contents):
+    """Return whether ``contents`` is a file-like object or an iterable of chunks.
+    """
+    if _is_text(contents) or _is_raw(contents):
+        return False
+    return hasattr(contents, 'read') or hasattr(contents, '__iter__')
+
+
+def _fileno(f):
+    """Return the file descriptor behind ``f``, or ``None`` if it hasn't got one.
+    """
+    try:
+        return f.fileno()
+    except (AttributeError, IOError, ValueError):  # io.UnsupportedOperation is both of the latter
+        return None
+
+
+_KERNEL_COPY_ERRNOS = set(getattr(errno, name) for name in ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF') if hasattr(errno, name))
+
+def _copy_source(src_path, f, chunk_size):
+    """Copy the file at ``src_path`` into the binary file ``f``.
+
+    The copy happens in the kernel, with :py:func:`os.copy_file_range` or else
+    :py:func:`os.sendfile`, where the platform and both files allow, and
+    through Python a chunk at a time otherwise.
+
+    """
+    with open(src_path, 'rb') as src:
+        infd, outfd = src.fileno(), _fileno(f)
+        copied = 0
+        if outfd is not None:
+            f.flush()
+            size = os.fstat(infd).st_size
+            for kernel_copy in _kernel_copies():
+                try:
+                    while copied < size:
+                        n = kernel_copy(infd, outfd, copied, size - copied)
+                        if n == 0:
+                            break
+                        copied += n
+                    return copied
+                except OSError as exc:
+                    if exc.errno not in _KERNEL_COPY_ERRNOS:
+                        raise
+        src.seek(copied)
+        shutil.copyfileobj(src, f, chunk_size)
+        return src.tell()
+
+
+def _kernel_copies():
+    """Yield functions ``(infd, outfd, offset, count)`` that copy between files
+    in the kernel, starting at ``offset`` in ``infd`` and at the current position
+    in ``outfd``, and return how many bytes they copied.
+    """
+    if hasattr(os, 'copy_file_range'):
+        yield lambda infd, outfd, offset, count: os.copy_file_range(infd, outfd, count, offset)
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        yield lambda infd, outfd, offset, count: os.sendfile(outfd, infd, offset, count)
+
+
+def _write_contents(f, contents, encoding, chunk_size):
+    """Write prepared contents to the binary file ``f``.
+
+    ``contents`` is either a bytestring from :py:func:`_encode`, raw contents
+    (a buffer, which is written as it is, a :py:class:`Source`, which is
+    copied, or a :py:class:`Sized`), or streamed contents, which are copied
+    over ``chunk_size`` characters or bytes at a time (for file-like objects)
+    or one chunk at a time (for iterables), with any text encoded as it goes.
+    Returns the number of bytes written.
+
+    """
+    if is_bytestring(contents) or is_buffer(contents):
+        f.write(contents)
+        return getattr(contents, 'nbytes', None) or len(contents)
+    if isinstance(contents, Source):
+        return _copy_source(contents.path, f, chunk_size)
+    if isinstance(contents, Sized):
+        _write_sized(f, contents, encoding, chunk_size)
+        return contents.size
+    if hasattr(contents, 'read'):
+        chunks = iter(partial(contents.read, chunk_size), contents.read(0))
+    else:
+        chunks = iter(contents)
+    encoder = None
+    written = 0
+    for chunk in chunks:
+        if not is_bytestring(chunk):
+            if encoder is None:
+                encoder = codecs.getincrementalencoder(encoding)()
+            chunk = encoder.encode(chunk)
+        f.write(chunk)
+        written += len(chunk)
+    if encoder is not None:
+        chunk = encoder.encode('', True)
+        f.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def _write_sized(f, sized, encoding, chunk_size):
+    """Write the contents described by the :py:class:`Sized` ``sized`` to ``f``.
+    """
+    fd = _fileno(f)
+    if sized.pattern is None and sized.seed is None and fd is not None:
+        f.flush()
+        if sized.allocate and hasattr(os, 'posix_fallocate') and sized.size:
+            os.posix_fallocate(fd, 0, sized.size)
+        else:
+            os.ftruncate(fd, sized.size)
+        return
+    chunk_size = max(4, chunk_size - chunk_size % 4)  # keep seeded output independent of chunk_size
+    for block in sized.blocks(chunk_size, encoding):
+        f.write(block)
+
+
+def _iter_contents(contents, encoding, chunk_size):
+    """Yield prepared contents (as for :py:func:`_write_contents`) as the
+    bytestrings that would be written, a chunk at a time.
+    """
+    if is_bytestring(contents) or is_buffer(contents):
+        yield contents
+    elif isinstance(contents, Source):
+        with open(contents.path, 'rb') as f:
+            for chunk in iter(partial(f.read, chunk_size), b''):
+                yield chunk
+    elif isinstance(contents, Sized):
+        for block in contents.blocks(max(4, chunk_size - chunk_size % 4), encoding):
+            yield block
+    else:
+        if hasattr(contents, 'read'):
+            chunks = iter(partial(contents.read, chunk_size), contents.read(0))
+        else:
+            chunks = iter(contents)
+        encoder = None
+        for chunk in chunks:
+            if not is_bytestring(chunk):
+                if encoder is None:
+                    encoder = codecs.getincrementalencoder(encoding)()
+                chunk = encoder.encode(chunk)
+            yield chunk
+        if encoder is not None:
+            yield encoder.encode('', True)
+
+
+def _contents_size(contents):
+    """Return how many bytes prepared ``contents`` come to, or ``None`` if
+    that can't be known without reading them.
+    """
+    if is_bytestring(contents) or is_buffer(contents):
+        return getattr(contents, 'nbytes', None) or len(contents)
+    if isinstance(contents, Source):
+        return os.stat(contents.path).st_size
+    if isinstance(contents, Sized):
+        return contents.size
+    return None
+
+
+def _hash_chunks(chunks):
+    """Return a hash of the concatenation of the bytestrings ``chunks``.
+    """
+    h = getattr(hashlib, 'blake2b', hashlib.sha1)()
+    for chunk in chunks:
+        h.update(chunk)
+    return h.digest()
+
+
+def _match_any(path, patterns):
+    """Return whether ``path`` matches any of the glob ``patterns`` (a string
+    or a sequence of them).
+    """
+    if is_stringy(patterns):
+        patterns = [patterns]
+    return any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns)
+
+
+def _list_dir(path):
+    """Return ``(name, is_dir, is_file, stat)`` for each entry in the
+    directory at ``path``, sorted by name, without following symlinks to
+    directories. ``stat`` is a function that stats the entry, using what
+    came with the listing where the platform allows.
+    """
+    if hasattr(os, 'scandir'):
+        with os.scandir(path) as entries:
+            return sorted((e.name, e.is_dir(follow_symlinks=False), e.is_file(), e.stat) for e in entries)
+    listing = []
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        listing.append((name, isdir(full) and not islink(full), os.path.isfile(full), partial(os.stat, full)))
+    return listing
+
+
+def _archive_path(name):
+    """Return the archive member ``name`` as a path relative to the root of
+    the tree, or ``None`` for the root itself.
+
+    :raises: :py:exc:`ValueError`, if the path would lead outside the tree
+
+    """
+    parts = [part for part in name.lstrip('/').split('/') if part not in ('', '.')]
+    if '..' in parts:
+        raise ValueError('archive member {0!r} is outside the tree'.format(name))
+    return '/'.join(parts) or None
+
+
+def _is_zip(f):
+    """Return whether the file object ``f`` holds a zip archive, leaving its
+    position where it was. Streams that can't seek are taken to be tarballs.
+    """
+    try:
+        if hasattr(f, 'seekable') and not f.seekable():
+            return False
+        position = f.tell()
+    except (AttributeError, IOError, OSError):
+        return False
+    try:
+        return zipfile.is_zipfile(f)
+    finally:
+        f.seek(position)
+
+
+def _archive_members(f):
+    """Yield ``(name, contents)`` for each directory (with ``None`` for
+    contents), regular file (with a file-like object), and hard link (with the
+    name of the member it links to) in the tar or zip archive open as ``f``,
+    in archive order, reading it as a stream where possible.
+    """
+    if _is_zip(f):
+        with zipfile.ZipFile(f) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    yield info.filename, None
+                else:
+                    with archive.open(info) as member:
+                        yield info.filename, member
+        return
+    with tarfile.open(fileobj=f, mode='r|*') as archive:
+        for info in archive:
+            if info.isdir():
+                yield info.name, None
+            elif info.isreg():
+                yield info.name, archive.extractfile(info)
+            elif info.islnk():
+                yield info.name, info.linkname
+
+
+def _random_bytes(rand, n):
+    """Return ``n`` bytes from the :py:class:`random.Random` ``rand``.
+    """
+    bits = rand.getrandbits(8 * n)
+    if hasattr(bits, 'to_bytes'):
+        return bits.to_bytes(n, 'little')
+    return binascii.unhexlify('%0*x' % (2 * n, bits))[::-1]
+
+
+_O_DIRECTORY = getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0)
+
+_fd_rmtree_supported = ( hasattr(os, 'scandir')
+                     and hasattr(os, 'supports_dir_fd')
+                     and set([os.open, os.unlink, os.rmdir]) <= os.supports_dir_fd
+                     and os.scandir in os.supports_fd
+                        )
+
+def _rmtree(path, workers=None, keep_root=False):
+    """Delete the directory tree at ``path``, or only its contents if
+    ``keep_root`` is true.
+
+    Where the platform allows, this walks the tree with :py:func:`os.scandir`
+    and deletes entries relative to an open descriptor for their directory,
+    using the entry type that comes with the directory listing, so there's no
+    path lookup from the top or extra stat per entry. With ``workers`` greater
+    than one, the top-level subdirectories are deleted in parallel. Elsewhere,
+    and for symlinks, this falls back to :py:func:`shutil.rmtree`.
+
+    """
+    if keep_root and not _fd_rmtree_supported:
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            if isdir(child) and not islink(child):
+                shutil.rmtree(child)
+            else:
+                os.remove(child)
+        return
+    if not _fd_rmtree_supported or islink(path):
+        shutil.rmtree(path)
+        return
+    fd = os.open(path, os.O_RDONLY | _O_DIRECTORY)
+    try:
+        subdirs = _rmtree_files(fd)
+        if ThreadPoolExecutor is None or workers is None or workers < 2 or len(subdirs) < 2:
+            for name in subdirs:
+                _rmtree_subdir(fd, name)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_rmtree_subdir, fd, name) for name in subdirs]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+    if not keep_root:
+        os.rmdir(path)
+
+
+def _rmtree_files(dir_fd):
+    """Delete everything but subdirectories in the directory open at
+    ``dir_fd``, returning the names of the subdirectories.
+    """
+    with os.scandir(dir_fd) as entries:
+        entries = list(entries)  # unlinking mid-listing slows down getdents
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.name)
+        else:
+            try:
+                os.unlink(entry.name, dir_fd=dir_fd)
+            except FileNotFoundError:
+                pass
+    return subdirs
+
+
+def _rmtree_subdir(dir_fd, name):
+    """Delete the subdirectory ``name`` of the directory open at ``dir_fd``.
+    """
+    fd = os.open(name, os.O_RDONLY | _O_DIRECTORY, dir_fd=dir_fd)
+    try:
+        for subdir in _rmtree_files(fd):
+            _rmtree_subdir(fd, subdir)
+    finally:
+        os.close(fd)
+    os.rmdir(name, dir_fd=dir_fd)
+
+
+GRAVEYARD_PREFIX = '.filesystem-tree-graveyard-'
+
+_reaper_lock = threading.Lock()
+_reaper_queue = None
+_graveyards = set()
+_burials = itertools.count()
+
+def _bury(path):
+    """Rename the tree at ``path`` into this process's graveyard beside it and
+    queue it for deletion, returning a :py:class:`Removal`, or ``None`` if it
+    can't be renamed.
+    """
+    parent = dirname(realpath(path))
+    graveyard = os.path.join(parent, GRAVEYARD_PREFIX + str(os.getpid()))
+    try:
+        if graveyard not in _graveyards:
+            _makedirs(graveyard)
+            _sweep_graveyards(parent)
+            _graveyards.add(graveyard)
+        grave = os.path.join(graveyard, '{0}-{1}'.format(os.path.basename(path), next(_burials)))
+        os.rename(path, grave)
+    except OSError:
+        return None
+    return _reap(grave)
+
+
+def _sweep_graveyards(parent):
+    """Queue the graveyards of dead processes in ``parent`` for deletion.
+    """
+    if os.name != 'posix':  # os.kill(pid, 0) would kill the process on Windows
+        return
+    for name in os.listdir(parent):
+        if not name.startswith(GRAVEYARD_PREFIX):
+            continue
+        try:
+            os.kill(int(name[len(GRAVEYARD_PREFIX):]), 0)
+        except ValueError:
+            continue
+        except OSError as exc:
+            if exc.errno == errno.ESRCH:
+                _reap(os.path.join(parent, name))
+
+
+def _reap(path):
+    """Queue the tree at ``path`` for deletion on the reaper thread.
+    """
+    global _reaper_queue
+    removal = Removal(path)
+    with _reaper_lock:
+        if _reaper_queue is None:
+            _reaper_queue = queue.Queue()
+            reaper = threading.Thread(target=_reaper, name='filesystem-tree-reaper')
+            reaper.daemon = True
+            reaper.start()
+            atexit.register(_wait_for_reaper)
+        _reaper_queue.put(removal)
+    return removal
+
+
+def _reaper():
+    while True:
+        removal = _reaper_queue.get()
+        try:
+            _rmtree(removal.path)
+        except Exception as exc:
+            removal._error = exc
+        finally:
+            removal._done.set()
+            _reaper_queue.task_done()
+
+
+def _wait_for_reaper():
+    """Finish deleting buried trees, then remove our now-empty graveyards.
+    """
+    _reaper_queue.join()
+    for graveyard in _graveyards:
+        try:
+            os.rmdir(graveyard)
+        except OSError:
+            pass
+
+
+_async_executor_lock = threading.Lock()
+_async_executor_instance = None
+
+def _async_executor(max_workers):
+    """Return the thread pool behind the asynchronous API, making it if need be.
+    """
+    global _async_executor_instance
+    with _async_executor_lock:
+        if _async_executor_instance is None:
+            _async_executor_instance = ThreadPoolExecutor(max_workers=max_workers)
+    return _async_executor_instance
+
+
+def _estimate_size(files):
+    """Estimate how many bytes the files from a parsed treedef will take up.
+    """
+    total = 0
+    for f in files:
+        contents = f[1]
+        if _is_text(contents):
+            total += len(contents)
+        elif is_buffer(contents):
+            total += memoryview(contents).nbytes
+        elif isinstance(contents, Source):
+            total += os.path.getsize(contents.path)
+        elif isinstance(contents, Sized) and not contents.is_sparse:
+            total += contents.size
+    return total
+
+
+def _filesystem_types():
+    """Return a dict mapping mount points to filesystem types, per ``/proc/mounts``.
+    """
+    try:
+        with open('/proc/mounts') as mounts:
+            lines = mounts.read().splitlines()
+    except (IOError, OSError):
+        return {}
+    return dict( (fields[1].replace('\\040', ' '), fields[2])
+                 for fields in (line.split() for line in lines)
+                 if len(fields) > 2
+                )
+
+
+def _ram_dirs(candidates):
+    """Yield those of ``candidates`` that are writable directories on a
+    RAM-backed filesystem, expanding environment variables.
+    """
+    types = _filesystem_types()
+    for path in candidates:
+        path = os.path.expandvars(path)
+        if '$' in path or not isdir(path) or not os.access(path, os.W_OK | os.X_OK):
+            continue
+        mount = realpath(path)
+        while mount not in types and dirname(mount) != mount:
+            mount = dirname(mount)
+        if types.get(mount) in ('tmpfs', 'ramfs'):
+            yield path
+
+
+def _free_space(path):
+    """Return how many bytes are available to us on the filesystem at ``path``.
+    """
+    if not hasattr(os, 'statvfs'):
+        return 0
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def _unlink(path):
+    """Like :py:func:`os.unlink`, but don't mind if ``path`` doesn't exist, and
+    return whether it did.
+    """
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def _reflink(src, dst):
+    """Make ``dst`` a copy-on-write clone of ``src``, or raise :py:exc:`OSError`.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported on this platform', dst)
+    with open(src, 'rb') as s:
+        with open(dst, 'wb+') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except IOError as exc:  # Python 2 raises IOError here
+                raise OSError(exc.errno, exc.strerror, dst)
+
+
+def _clone_file(src, dst, link):
+    """Clone one regular file from ``src`` to ``dst`` using ``link``.
+    """
+    if link == 'hardlink':
+        os.link(src, dst)
+    elif link == 'reflink':
+        _reflink(src, dst)
+    elif link == 'copy':
+        shutil.copyfile(src, dst)
+    elif link == 'auto':
+        try:
+            _reflink(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+    else:
+        raise ValueError("link must be 'auto', 'reflink', 'hardlink', or 'copy'")
+
+
+def _copy_tree(src, dst, link):
+    """Copy the contents of the directory ``src`` into the directory ``dst``,
+    cloning regular files with ``link`` (as for :py:func:`_clone_file`) and
+    keeping symlinks, and return the paths (relative to ``dst``) of the
+    regular files.
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        relpath = os.path.relpath(dirpath, src)
+        target = os.path.join(dst, relpath)
+        if not isdir(target):
+            os.makedirs(target)
+        for name in dirnames + filenames:
+            source = os.path.join(dirpath, name)
+            if islink(source):
+                os.symlink(os.readlink(source), os.path.join(target, name))
+            elif name in filenames:
+                _clone_file(source, os.path.join(target, name), link)
+                files.append(name if relpath == os.curdir else os.path.join(relpath, name))
+    return files
+
+
+def _fsync_tree(path):
+    """Flush the regular files and directories under ``path`` to disk.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            if not islink(full):
+                fd = os.open(full, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        _fsync_dir(dirpath)
+
+
+def _fsync_dir(path):
+    """Flush the directory entries in ``path`` to disk, where the platform
+    allows.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    except OSError:
+        return  # Windows can't open directories
+    try:
+        os.fsync(fd)
+    except OSError as exc:
+        if exc.errno not in (errno.EINVAL, errno.EBADF):
+            raise
+    finally:
+        os.close(fd)
+
+
+RENAME_EXCHANGE = 2     # from linux/fs.h; swaps two paths atomically
+_AT_FDCWD = -100
+_renameat2 = None       # looked up on first use; False where libc hasn't got it
+
+def _exchange(a, b):
+    """Atomically swap the paths ``a`` and ``b`` with :manpage:`renameat2(2)`,
+    returning ``False`` where the platform or filesystem can't.
+    """
+    global _renameat2
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return False
+    if _renameat2 is None:
+        try:
+            _renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+        except (AttributeError, OSError):
+            _renameat2 = False
+    if _renameat2 is False:
+        return False
+    encode = getattr(os, 'fsencode', lambda path: path.encode(sys.getfilesystemencoding()))
+    if _renameat2(_AT_FDCWD, encode(a), _AT_FDCWD, encode(b), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, getattr(errno, 'EOPNOTSUPP', None)):
+        return False
+    raise OSError(err, os.strerror(err), a)
+
+
+class Source(object):
+    """File contents to copy from an existing file.
+
+    :param string path: The path of the file to copy
+
+    Use this in place of a string in a file tuple to seed a tree with a big
+    file that's already on disk, without reading it into Python:
+
+    >>> ft = FilesystemTree(('greetings/program.txt', 'Greetings, program!'))
+    >>> ft.mk(('copy.txt', Source(ft.resolve('greetings/program.txt'))))
+    >>> open(ft.resolve('copy.txt')).read()
+    'Greetings, program!'
+
+    Where the platform allows, the bytes are copied by the kernel without
+    passing through Python at all. The contents are never dedented.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return '<Source {0!r}>'.format(self.path)
+
+
+class LazyFile(Source):
+    """The contents of a file in a :py:func:`FilesystemTree.snapshot`, read
+    only when asked for.
+
+    :param string path: The path of the file
+
+    This is a read-only file-like object: the file is opened on the first
+    call to :py:func:`read`, and closed again once it's been read to the end.
+    It's also a :py:class:`Source`, so passing it back to
+    :py:func:`FilesystemTree.mk` copies the whole file, however much of it
+    has been read.
+
+    """
+
+    _file = None
+    _eof = False
+    _stat = None
+
+    @property
+    def size(self):
+        """The size of the file in bytes, taken from the directory listing
+        it came from where possible.
+        """
+        st = os.stat(self.path) if self._stat is None else self._stat()
+        return st.st_size
+
+    def read(self, size=-1):
+        """Read and return up to ``size`` bytes, or the rest of the file if
+        ``size`` is negative.
+        """
+        if self._eof:
+            return b''
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        data = self._file.read(size)
+        if size < 0 or (not data and size != 0):
+            self.close()
+            self._eof = True
+        return data
+
+    def close(self):
+        """Close the file, if it's open.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __repr__(self):
+        return '<LazyFile {0!r}>'.format(self.path)
+
+
+class Sized(object):
+    """File contents described by their size.
+
+    :param int size: How many bytes long the file is
+
+    :param pattern: A string or bytestring to fill the file with, over and over
+
+    :param seed: A seed for :py:class:`random.Random`, to fill the file with
+        reproducible pseudo-random bytes
+
+    :param bool allocate: Whether to reserve disk space for a file with neither
+        ``pattern`` nor ``seed``, rather than leave it sparse
+
+    Use this in place of a string in a file tuple for files whose size matters
+    but whose contents don't, such as for testing upload limits:
+
+    >>> ft = FilesystemTree(('big.bin', Sized(10 * 1024 ** 2)))
+    >>> os.path.getsize(ft.resolve('big.bin')) == 10 * 1024 ** 2
+    True
+    >>> ft.remove()
+
+    With neither ``pattern`` nor ``seed``, the file is all zeros, and is made
+    sparse where the filesystem allows, so it costs next to nothing. Otherwise
+    the contents are generated and written a block at a time, so they're never
+    all in memory at once. A string ``pattern`` is encoded with the file's
+    encoding, and is never dedented.
+
+    """
+
+    def __init__(self, size, pattern=None, seed=None, allocate=False):
+        if size < 0:
+            raise ValueError('size must not be negative')
+        if pattern is not None and seed is not None:
+            raise ValueError('pass pattern or seed, not both')
+        if pattern is not None and len(pattern) == 0:
+            raise ValueError('pattern must not be empty')
+        self.size = size
+        self.pattern = pattern
+        self.seed = seed
+        self.allocate = allocate
+
+    def __repr__(self):
+        return '<Sized {0!r}>'.format(self.size)
+
+    @property
+    def is_sparse(self):
+        """Whether the file can be left sparse on disk.
+        """
+        return self.pattern is None and self.seed is None and not self.allocate
+
+    def blocks(self, block_size, encoding='UTF-8'):
+        """Yield the contents as bytestrings of up to about ``block_size`` bytes.
+        """
+        remaining = self.size
+        if self.seed is not None:
+            rand = random.Random(self.seed)
+            while remaining > 0:
+                n = min(block_size, remaining)
+                yield _random_bytes(rand, n)
+                remaining -= n
+            return
+        pattern = self.pattern if self.pattern is not None else b'\0'
+        if not is_bytestring(pattern):
+            pattern = pattern.encode(encoding)
+        block = pattern * max(1, block_size // len(pattern))
+        while remaining > 0:
+            chunk = block[:remaining]
+            yield chunk
+            remaining -= len(chunk)
+
+
+class ContentCache(object):
+    """A bounded, thread-safe LRU cache of dedented and encoded file contents.
+
+    :param int maxsize: The most entries to keep
+
+    :param int max_bytes: The most bytes of contents (before and after
+        preparing them) to keep
+
+    :param int max_item_bytes: Contents longer than this are never cached
+
+    Test suites tend to pass the same literal strings to
+    :py:func:`FilesystemTree.mk` over and over, and dedenting is
+    comparatively slow, so :py:attr:`FilesystemTree.content_cache` keeps the
+    results of preparing recent contents, keyed on ``(contents,
+    should_dedent, encoding)``. Contents that are big or seldom repeated
+    don't make it grow beyond its limits; the least recently used entries go
+    first.
+
+    """
+
+    def __init__(self, maxsize=1024, max_bytes=16 * 1024 * 1024, max_item_bytes=64 * 1024):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, contents, should_dedent, encoding, prepare=_encode):
+        """Return ``contents`` dedented and encoded, as by :py:func:`FilesystemTree.mk`.
+
+        ``prepare`` is what does the work on a miss; it takes the same
+        arguments as this method, less itself.
+
+        """
+        if len(contents) > self.max_item_bytes or not should_dedent and is_bytestring(contents):
+            return prepare(contents, should_dedent, encoding)
+        key = (type(contents), contents, bool(should_dedent), encoding)
+        with self._lock:
+            encoded = self._entries.pop(key, None)
+            if encoded is not None:
+                self._entries[key] = encoded  # most recently used goes last
+                self.hits += 1
+                return encoded
+            self.misses += 1
+        encoded = prepare(contents, should_dedent, encoding)
+        cost = len(contents) + len(encoded)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = encoded
+                self._bytes += cost
+            while self._entries and (len(self._entries) > self.maxsize or self._bytes > self.max_bytes):
+                (_, old, _, _), old_encoded = self._entries.popitem(last=False)
+                self._bytes -= len(old) + len(old_encoded)
+        return encoded
+
+    def stats(self):
+        """Return a dict of ``hits``, ``misses``, ``size`` (the number of
+        entries), and ``bytes``.
+        """
+        with self._lock:
+            return { 'hits': self.hits
+                   , 'misses': self.misses
+                   , 'size': len(self._entries)
+                   , 'bytes': self._bytes
+                    }
+
+    def clear(self):
+        """Empty the cache and zero the stats.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = self.hits = self.misses = 0
+
+
+class Event(collections.namedtuple('Event', 'op path bytes duration')):
+    """Something a :py:class:`FilesystemTree` did, as passed to its
+    :py:attr:`~FilesystemTree.observer`.
+
+    ``op`` is one of ``'mkdir'``, ``'dedent'``, ``'encode'``, ``'write'``,
+    ``'link'`` (a deduped file), or ``'remove'``; ``path`` is relative to
+    :py:attr:`~FilesystemTree.root` (and empty for ``'remove'``); ``bytes`` is
+    how many bytes were encoded or written, or ``None``; and ``duration`` is
+    in seconds.
+
+    """
+    __slots__ = ()
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class TreeDiff(collections.namedtuple('TreeDiff', 'added removed changed')):
+    """How a tree differs from a treedef, as returned by
+    :py:func:`FilesystemTree.diff`.
+
+    ``added`` lists the paths in the tree that aren't in the treedef,
+    ``removed`` the paths in the treedef that aren't in the tree, and
+    ``changed`` the files whose contents differ, all sorted and using ``/``
+    as the separator. A diff is false when there are no differences.
+
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        lines = []
+        for sign, paths in (('+', self.added), ('-', self.removed), ('~', self.changed)):
+            lines.extend('{0} {1}'.format(sign, path) for path in paths)
+        return '\n'.join(lines)
+
+
+class Removal(object):
+    """A handle on a tree that :py:func:`FilesystemTree.remove` is deleting in
+    the background.
+    """
+
+    path = None  #: Where the tree is being deleted from, in a graveyard directory.
+
+    def __init__(self, path):
+        self.path = path
+        self._done = threading.Event()
+        self._error = None
+
+    def done(self):
+        """Return whether the tree has been deleted (or deleting it failed).
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the tree has been deleted, or ``timeout`` seconds pass.
+
+        :returns: whether the tree has been deleted
+
+        :raises: the exception (usually an :py:exc:`OSError`) that deleting
+            the tree failed with, if it failed
+
+        """
+        self._done.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._done.is_set()
+
+
+_STATS = ('syscalls', 'dirs_created', 'files_written', 'bytes_written', 'removals')
+
 
 class FilesystemTree(object):
     """Represent a filesystem tree.
@@ -71,6 +1233,23 @@ class FilesystemTree(object):
     :param str encoding: Sets the instance default for what encoding to use when
         writing to disk. (May only be supplied as a keyword argument.)
 
+    :param int workers: Sets the instance default for how many threads
+        :py:func:`mk` uses to write files. (May only be supplied as a keyword
+        argument.)
+
+    :param str dedup: Sets the instance default for how :py:func:`mk` dedupes
+        identical files. (May only be supplied as a keyword argument.)
+
+    :param str storage: Where to make the temporary directory if ``root``
+        isn't given: ``'disk'`` uses the system default, ``'ram'`` uses a
+        writable RAM-backed filesystem from :py:attr:`ram_dirs` (raising
+        :py:exc:`OSError` if there isn't one), and ``'auto'`` uses one of those
+        if it has room for ``treedef`` plus :py:attr:`ram_reserve` bytes, and
+        the disk otherwise. (May only be supplied as a keyword argument.)
+
+    :param observer: Sets :py:attr:`observer`. (May only be supplied as a
+        keyword argument.)
+
     Create a new instance of this class every time you need an isolated
     filesystem tree:
 
@@ -98,8 +1277,33 @@ class FilesystemTree(object):
     root = None                 #: The root of the filesystem tree that this object represents.
     should_dedent = True        #: Whether or not to automatically dedent file contents on write.
     encoding = 'UTF-8'          #: How to encode file contents on write, when necessary.
+    workers = None              #: How many threads :py:func:`mk` writes files with; ``None`` means serially.
+    storage = 'disk'            #: Where to make a temporary :py:attr:`root`: ``'disk'``, ``'ram'``, or ``'auto'``.
+    ram_dirs = ('/dev/shm', '$XDG_RUNTIME_DIR')   #: Where to look for RAM-backed filesystems, in order.
+    ram_reserve = 64 * 1024 * 1024                #: How many bytes to leave free on a RAM-backed filesystem under ``'auto'``.
+    chunk_size = 64 * 1024      #: How much of a file-like object's contents :py:func:`mk` reads at a time.
+    dedup = None                #: How :py:func:`mk` dedupes identical files: ``None``, ``'hardlink'``, or ``'reflink'``.
+    blob_dir = '.filesystem-tree-blobs'  #: Where under :py:attr:`root` :py:func:`mk` keeps deduped file bodies.
+    content_cache = ContentCache()  #: A :py:class:`ContentCache` for file contents, shared by default; ``None`` turns caching off.
+    remove_workers = None       #: How many threads :py:func:`remove` deletes top-level subdirectories with; ``None`` means serially.
+    remove_in_background = False  #: Whether :py:func:`remove` deletes the tree on a background thread by default.
+    async_workers = 4           #: The size of the thread pool shared by :py:func:`amk` and :py:func:`aremove`; read when the pool is first used.
+    observer = None             #: A function to call with an :py:class:`Event` for each thing the tree does; ``None`` means nobody's watching.
+    resolve_cache_size = 1024   #: How many results :py:func:`resolve` remembers.
+    dir_fds = 0                 #: How many subdirectories :py:func:`mk` keeps open (besides :py:attr:`root`) to write files into when writing serially.
 
     _sep = os.sep
+    _known_dirs_root = None
+    _pool = None
+    _manifest = None
+    _manifest_dirs = None
+    _manifest_root = None
+    _hardlinked_root = None
+    _written_blobs_root = None
+    _dir_fds_root = None
+    _resolved_root = None
+    _journal_root = None
+    _made_root = None
 
 
     def __init__(self, *treedef, **kw):
@@ -108,15 +1312,51 @@ class FilesystemTree(object):
         root = kw.get('root', self.root)
         should_dedent = kw.get('should_dedent', self.should_dedent)
         encoding = kw.get('encoding', self.encoding)
-
-        self.root = root if root is not None else realpath(tempfile.mkdtemp(prefix=self.prefix))
+        workers = kw.get('workers', self.workers)
+        dedup = kw.get('dedup', self.dedup)
+        storage = kw.get('storage', self.storage)
+        observer = kw.get('observer', self.observer)
+
+        self._counters = dict.fromkeys(_STATS, 0)
+        self._counters_lock = threading.Lock()
+
+        if root is None:
+            parent = None
+            if storage != 'disk':
+                _, files = _parse_treedef(treedef, should_dedent, encoding, self._sep)
+                parent = self._choose_storage(storage, _estimate_size(files))
+            root = realpath(tempfile.mkdtemp(prefix=self.prefix, dir=parent))
+            self._made_root = root
+
+        self.root = root
         self.should_dedent = should_dedent
         self.encoding = encoding
+        self.workers = workers
+        self.dedup = dedup
+        self.storage = storage
+        self.observer = observer
 
         if treedef is not None:
             self.mk(*treedef)
 
 
+    def _choose_storage(self, storage, size):
+        """Return the directory to make a temporary root in, or ``None`` for
+        the system default.
+        """
+        if storage == 'disk':
+            return None
+        if storage not in ('ram', 'auto'):
+            raise ValueError("storage must be 'disk', 'ram', or 'auto'")
+        needed = size if storage == 'ram' else size + self.ram_reserve
+        for path in _ram_dirs(self.ram_dirs):
+            if _free_space(path) >= needed:
+                return path
+        if storage == 'ram':
+            raise OSError(errno.ENOSPC, 'no RAM-backed filesystem with room for the tree')
+        return None
+
+
     def __enter__(self):
         """Support using a FilesystemTree as a context manager.
         """
@@ -130,6 +1370,50 @@ class FilesystemTree(object):
             self.remove()
 
 
+    def __aenter__(self):
+        """Support using a FilesystemTree as an asynchronous context manager.
+        """
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(self)
+        return future
+
+
+    def __aexit__(self, exc_type, exc_value, tb):
+        """When exiting an asynchronous context, only do cleanup if it was a
+        clean exit, using :py:func:`aremove`.
+        """
+        if exc_type == None and exc_value == None and tb == None:
+            return self.aremove()
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(None)
+        return future
+
+
+    def amk(self, *treedef, **kw):
+        """Like :py:func:`mk`, but return an :py:mod:`asyncio` future.
+
+        The work runs as a single job on a thread pool shared by all trees, so
+        concurrent fixtures never use more than :py:attr:`async_workers`
+        threads between them::
+
+            async with FilesystemTree() as ft:
+                await ft.amk(('greetings/program.txt', 'Greetings, program!'))
+
+        """
+        return self._run_async(self.mk, *treedef, **kw)
+
+
+    def aremove(self):
+        """Like :py:func:`remove`, but return an :py:mod:`asyncio` future.
+        """
+        return self._run_async(self.remove)
+
+
+    def _run_async(self, func, *args, **kw):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(_async_executor(self.async_workers), partial(func, *args, **kw))
+
+
     def mk(self, *treedef, **kw):
         """Builds a filesystem tree in :py:attr:`~FilesystemTree.root` based on ``treedef``.
 
@@ -146,9 +1430,30 @@ class FilesystemTree(object):
             :py:attr:`encoding` is used. (May only be supplied as a keyword
             argument.)
 
+        :param int workers:         If greater than one, write files from a
+            pool of this many threads, after creating all directories. If not
+            specified, :py:attr:`workers` is used. (May only be supplied as a
+            keyword argument.)
+
+        :param str dedup:           Set to ``'hardlink'`` (or ``True``) or
+            ``'reflink'`` to store each distinct file body once, as described
+            below. If not specified, :py:attr:`dedup` is used. (May only be
+            supplied as a keyword argument.)
+
+        :param bool atomic:         Set to ``True`` to build the tree in a
+            staging directory and publish it all at once, as described below.
+            (May only be supplied as a keyword argument.)
+
+        :param bool fsync:          With ``atomic``, set to ``True`` to flush
+            the staged tree to disk before publishing it. (May only be
+            supplied as a keyword argument.)
+
         :raises:                    :py:exc:`TypeError`, if treedef contains
-            anything besides strings and tuples; :py:exc:`ValueError`, if
-            treedef contains a tuple that doesn't have two or three items
+            anything besides strings and tuples, or file contents that aren't
+            one of the kinds described below; :py:exc:`ValueError`, if
+            ``dedup`` isn't one of the values above, or if treedef contains a
+            tuple that doesn't have two to four items (both are raised before
+            anything is written)
 
         :returns: ``None``
 
@@ -162,6 +1467,43 @@ class FilesystemTree(object):
         path separator for the current platform). Any intermediate directories
         will be created as necessary.
 
+        File contents may be a string, or, for files too big to hold in memory,
+        a file-like object (anything with a ``read`` method) or an iterable of
+        strings, such as a generator. Those are streamed to disk a chunk at a
+        time, and strings among them are encoded incrementally. Contents may
+        also be a :py:class:`Source`, to copy an existing file, a
+        :py:class:`Sized`, to make a file of a given size, or a ``bytearray``,
+        ``memoryview``, or ``mmap``, which is written as it is. None of these
+        are ever dedented.
+
+        Trees with thousands of identical files (empty ``__init__.py`` files,
+        say) can be deduped. Then each distinct body among string and buffer
+        contents is written once, to a content store in :py:attr:`blob_dir`,
+        and the files are hardlinked to it, or, with ``'reflink'``, cloned
+        from it copy-on-write (or copied, where the filesystem can't do that).
+        Hardlinked files share their contents, so writing to one in place
+        changes them all; use ``'reflink'`` if the code under test does that.
+        Files that :py:func:`mk` writes again are replaced, not written
+        through, and a body in the store that was changed through a link is
+        written afresh before anything new is linked to it.
+
+        Usually files appear one at a time, and if something goes wrong partway
+        through (an encoding error, say, or a full disk), what was written
+        stays written. With ``atomic=True``, the current contents of
+        :py:attr:`root` are hardlinked into a staging directory beside it, the
+        tree is built there (replacing files rather than writing through the
+        links), and then the staging directory is swapped into place with one
+        atomic rename, so other processes see the whole tree or none of it.
+        On Linux the swap is a single :manpage:`renameat2(2)` exchange;
+        elsewhere :py:attr:`root` is briefly missing between two renames. If
+        anything fails, the staging directory is deleted and :py:attr:`root`
+        is left as it was. The old tree is deleted afterwards, in the
+        background if :py:attr:`remove_in_background` is set.
+
+        The tree remembers which directories it has made, so each one is only
+        checked once; that memory is cleared by :py:func:`remove` and whenever
+        :py:attr:`root` changes.
+
         So for example if you instantiate a :py:class:`FilesystemTree`:
 
         >>> ft = FilesystemTree()
@@ -205,45 +1547,592 @@ class FilesystemTree(object):
         """
         should_dedent = kw.get('should_dedent', self.should_dedent)
         encoding = kw.get('encoding', self.encoding)
-        convert_path = lambda path: self._sep.join(path.split('/'))
-
-        for item in treedef:
-            if is_stringy(item):
-                path = convert_path(item.lstrip('/'))
-                path = self._sep.join([self.root, path])
-                if not isdir(path):
-                    os.makedirs(path)
-            elif isinstance(item, tuple):
-
-                if len(item) == 2:
-                    filepath, contents = item
-                    should_dedent = should_dedent
-                    encoding = encoding
-                elif len(item) == 3:
-                    filepath, contents, should_dedent = item
-                    encoding = encoding
-                elif len(item) == 4:
-                    filepath, contents, should_dedent, encoding = item
+        workers = kw.get('workers', self.workers)
+        dedup = kw.get('dedup', self.dedup)
+
+        if dedup not in (None, False, True, 'hardlink', 'reflink'):
+            raise ValueError("dedup must be None, 'hardlink', or 'reflink'")
+        if kw.get('atomic'):
+            return self._mk_atomic(treedef, should_dedent, encoding, workers, dedup, kw.get('fsync', False))
+        try:
+            if len(treedef) == 1 and isinstance(treedef[0], Plan) and not dedup and self._sep == '/':
+                plan = treedef[0]
+                return self._build(plan.dirs, plan.files, workers, parents=False, recheck=plan.leaves)
+            dirs, files = _parse_treedef(treedef, should_dedent, encoding, self._sep)
+            if dedup:
+                files = self._dedup(dirs, files, 'reflink' if dedup == 'reflink' else 'hardlink')
+            self._build(dirs, files, workers)
+        finally:
+            self._drop_dir_fds()
+
+
+    def _mk_atomic(self, treedef, should_dedent, encoding, workers, dedup, fsync):
+        """Build ``treedef`` on a copy of the tree in a staging directory and
+        swap it in for :py:attr:`root`.
+        """
+        root = realpath(self.root)
+        exists = isdir(root)
+        staging = tempfile.mkdtemp(prefix='.filesystem-tree-staging-', dir=dirname(root))
+        try:
+            stage = self.__class__(root=staging, observer=self.observer)
+            for name, value in vars(self).items():
+                if not name.startswith('_') and name != 'root':
+                    setattr(stage, name, value)  # blob_dir, chunk_size, and so on
+            if exists:
+                os.chmod(staging, os.stat(root).st_mode & 0o7777)
+                stage._hardlinked().update(_copy_tree(root, staging, 'hardlink'))
+                if self._manifest is not None and self._manifest_root == self.root:
+                    stage._manifest = dict(self._manifest)
+                    stage._manifest_dirs = set(self._manifest_dirs)
+                    stage._manifest_root = staging
+            stage.mk(*treedef, should_dedent=should_dedent, encoding=encoding, workers=workers, dedup=dedup)
+            if fsync:
+                _fsync_tree(staging)
+            if not exists:
+                os.rename(staging, root)
+            elif not _exchange(staging, root):
+                old = staging + '-old'
+                os.rename(root, old)
+                try:
+                    os.rename(staging, root)
+                except OSError:
+                    os.rename(old, root)
+                    raise
+                staging = old
+        except BaseException:
+            if isdir(staging):
+                _rmtree(staging)
+            raise
+        if fsync:
+            _fsync_dir(dirname(root))
+
+        self._forget_dirs()
+        self._drop_dir_fds()
+        with self._counters_lock:
+            for key, n in stage.stats().items():
+                self._counters[key] += n
+        self._hardlinked_cache, self._hardlinked_root = stage._hardlinked(), self.root
+        self._written_blobs_cache, self._written_blobs_root = stage._written_blobs(), self.root
+        self._journal().extend(stage._journal())
+        if stage._manifest is not None:
+            self._manifest, self._manifest_dirs, self._manifest_root = \
+                                                        stage._manifest, stage._manifest_dirs, self.root
+        if exists:
+            if not (self.remove_in_background and _bury(staging) is not None):
+                _rmtree(staging, self.remove_workers)
+
+
+    def _dedup(self, dirs, files, link):
+        """Write each distinct body among ``files`` to the content store once,
+        and link the files to it, returning the files that can't be deduped.
+        """
+        blobs, links, rest = {}, [], []
+        for f in files:
+            path, contents, should_dedent, encoding = f
+            if _is_text(contents):
+                contents = self._encode(contents, should_dedent, encoding, path)
+            digest = _digest(contents)
+            if digest is None:
+                rest.append(f)
+                continue
+            blob = self._sep.join([self.blob_dir, binascii.hexlify(digest).decode('ascii')])
+            blobs.setdefault(blob, (contents, digest))
+            links.append((path, blob, digest))
+
+        self._make_dirs(dirs + [self.blob_dir] + [dirname(path) for path, _, _ in links], dirs)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+        written_blobs = self._written_blobs()
+        for blob, (contents, digest) in blobs.items():
+            full = self._sep.join([self.root, blob])
+            try:
+                fd = os.open(full, flags, 0o666)
+                self._journal().append(blob)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+                if self._blob_is_intact(blob, digest):
+                    continue
+                # Something wrote through a link to it; its twins keep what
+                # they have now, and new links get the right contents.
+                os.unlink(full)
+                fd = os.open(full, flags, 0o666)
+            with os.fdopen(fd, 'wb') as f:
+                written = _write_contents(f, contents, None, self.chunk_size)
+                f.flush()
+                written_blobs[blob] = _blob_record(os.fstat(fd))
+            self._tally(4, files_written=1, bytes_written=written)
+
+        observer = self.observer
+        hardlinked = self._hardlinked()
+        for path, blob, digest in links:
+            if observer is not None:
+                start = _clock()
+            full = self._sep.join([self.root, path])
+            if not _unlink(full):
+                self._journal().append(path)
+            if link == 'hardlink':
+                os.link(self._sep.join([self.root, blob]), full)
+                hardlinked.add(path)
+            else:
+                _clone_file(self._sep.join([self.root, blob]), full, 'auto')
+                hardlinked.discard(path)
+            if self._manifest is not None:
+                self._manifest[path] = self._stat_record(path, digest)
+            self._tally(2)
+            if observer is not None:
+                observer(Event('link', path, None, _clock() - start))
+        return rest
+
+
+    def _encode(self, contents, should_dedent, encoding, path=None):
+        prepare = _encode if self.observer is None else partial(self._observed_encode, path)
+        if self.content_cache is None:
+            return prepare(contents, should_dedent, encoding)
+        return self.content_cache.encode(contents, should_dedent, encoding, prepare)
+
+
+    def _observed_encode(self, path, contents, should_dedent, encoding):
+        """Like :py:func:`_encode`, but tell :py:attr:`observer` how long each
+        step took.
+        """
+        start = _clock()
+        if should_dedent:
+            contents = dedent(contents)
+            now = _clock()
+            self.observer(Event('dedent', path, None, now - start))
+            start = now
+        if not is_bytestring(contents):
+            contents = contents.encode(encoding)
+            self.observer(Event('encode', path, len(contents), _clock() - start))
+        return contents
+
+
+    def stats(self):
+        """Return a dict of what this tree has done so far.
+
+        The keys are ``syscalls`` (roughly how many calls into the
+        filesystem the tree has made, not counting those inside
+        :py:func:`remove`), ``dirs_created``, ``files_written``,
+        ``bytes_written``, and ``removals``:
+
+        >>> ft = FilesystemTree(('path/to/file.txt', 'Greetings, program!'))
+        >>> stats = ft.stats()
+        >>> stats['dirs_created'], stats['files_written'], stats['bytes_written']
+        (2, 1, 19)
+
+        The counters are always kept, since they only cost an addition or
+        two per file. For the time each step takes, set :py:attr:`observer`
+        to a function; it's called with an :py:class:`Event` for each
+        directory made, file contents dedented and encoded (unless they came
+        from :py:attr:`content_cache`), file written or linked, and tree
+        removed. Nothing is timed when :py:attr:`observer` is ``None``. The
+        observer may be called from several threads at once if
+        :py:attr:`workers` is set.
+
+        """
+        with self._counters_lock:
+            return dict(self._counters)
+
+
+    def _tally(self, syscalls, dirs_created=0, files_written=0, bytes_written=0, removals=0):
+        with self._counters_lock:
+            counters = self._counters
+            counters['syscalls'] += syscalls
+            counters['dirs_created'] += dirs_created
+            counters['files_written'] += files_written
+            counters['bytes_written'] += bytes_written
+            counters['removals'] += removals
+
+
+    def _written_blobs(self):
+        """Return a dict of the blobs in the content store that :py:func:`mk`
+        wrote, to their size, modification time, and inode number when it
+        did, starting over if :py:attr:`root` has changed.
+        """
+        if self._written_blobs_root != self.root:
+            self._written_blobs_cache = {}
+            self._written_blobs_root = self.root
+        return self._written_blobs_cache
+
+
+    def _blob_is_intact(self, blob, digest):
+        """Return whether the blob at ``blob`` in the content store still has
+        the contents that hash to ``digest``.
+
+        Hardlinked files share their blob, so code under test that writes to
+        one in place changes the blob too. Blobs that look as they did when
+        we wrote them are trusted; any others are hashed.
+
+        """
+        full = self._sep.join([self.root, blob])
+        written_blobs = self._written_blobs()
+        record = _blob_record(os.stat(full))
+        self._tally(1)
+        if written_blobs.get(blob) == record:
+            return True
+        if _file_digest(full, self.chunk_size) != digest:
+            return False
+        written_blobs[blob] = record
+        return True
+
+
+    def _hardlinked(self):
+        """Return the set of files (relative to :py:attr:`root`) that
+        :py:func:`mk` hardlinked to the content store, starting over if
+        :py:attr:`root` has changed.
+        """
+        if self._hardlinked_root != self.root:
+            self._hardlinked_cache = set()
+            self._hardlinked_root = self.root
+        return self._hardlinked_cache
+
+
+    def _build(self, dirs, files, workers, parents=True, recheck=None):
+        """Make parsed directories and files. Pass ``parents=False`` if
+        ``dirs`` already includes the parents of ``files``, along with the
+        directories to ``recheck`` (by default, all of ``dirs``).
+        """
+        if recheck is None:
+            recheck = dirs
+        if parents:
+            dirs = dirs + [dirname(f[0]) for f in files]
+        self._make_dirs(dirs, recheck)
+        if self._manifest is not None:
+            self._manifest_dirs.update(dirs)
+
+        if ThreadPoolExecutor is None or workers is None or workers < 2 or len(files) < 2:
+            for f in files:
+                self._write_file(*f, cached_dirs=True)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(self._write_file, *f) for f in files]
+            for future in futures:
+                future.result()  # raise the first failure in treedef order
+
+
+    def reset(self, *treedef, **kw):
+        """Make the tree match ``treedef``, changing as little as possible.
+
+        This takes the same arguments as :py:func:`mk`. It's a cheaper
+        alternative to calling :py:func:`remove` and then :py:func:`mk` between
+        tests:
+
+        >>> ft = FilesystemTree()
+        >>> ft.reset(('a.txt', 'a'), ('b.txt', 'b'))
+        >>> ft.reset(('a.txt', 'a'), ('c.txt', 'c'))
+        >>> print(' '.join(sorted(os.listdir(ft.root))))
+        a.txt c.txt
+
+        The first call builds ``treedef`` from scratch, after deleting what
+        :py:func:`mk` created before that isn't in ``treedef`` (as
+        :py:func:`undo` would); nothing else under :py:attr:`root` is touched.
+        From then on the tree keeps a manifest of the size, content
+        hash, and modification time of each file it writes (with
+        :py:func:`mk` too), and later calls
+        only write files whose contents differ from the manifest (or whose size
+        or modification time on disk no longer match it), and only delete
+        files and directories from the manifest that aren't in ``treedef``
+        (directories only if they're empty). Anything else under
+        :py:attr:`root` is left alone. Streamed contents, :py:class:`Source`,
+        and :py:class:`Sized` files are always rewritten. The manifest is
+        dropped by :py:func:`remove` and when :py:attr:`root` changes.
+
+        """
+        should_dedent = kw.get('should_dedent', self.should_dedent)
+        encoding = kw.get('encoding', self.encoding)
+        workers = kw.get('workers', self.workers)
+
+        dirs, files = _parse_treedef(treedef, should_dedent, encoding, self._sep)
+
+        wanted = set(f[0] for f in files)
+        wanted_dirs = set()
+        for path in dirs + [dirname(path) for path in wanted]:
+            while path not in wanted_dirs:
+                wanted_dirs.add(path)
+                path = dirname(path)
+
+        try:
+            if self._manifest is None or self._manifest_root != self.root:
+                self._undo_unwanted(wanted, wanted_dirs)
+                self._forget_dirs()
+                self._manifest, self._manifest_dirs, self._manifest_root = {}, set(), self.root
+                return self._build(dirs, files, workers)
+
+            changed = []
+            for path, contents, should_dedent, encoding in files:
+                record = self._manifest.get(path)
+                if _is_text(contents):
+                    contents = self._encode(contents, should_dedent, encoding)
+                    should_dedent = False
+                if record is not None and record[1] is not None:
+                    if record[1] == _digest(contents) and record == self._stat_record(path, record[1]):
+                        continue
+                changed.append((path, contents, should_dedent, encoding))
+
+            journal = self._journal()
+            for path in [path for path in self._manifest if path not in wanted]:
+                del self._manifest[path]
+                journal.pop(path, None)
+                try:
+                    os.unlink(self._sep.join([self.root, path]))
+                except OSError as exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+            stale = sorted(self._manifest_dirs - wanted_dirs - set(['']), reverse=True)
+            for path in stale:
+                try:
+                    os.rmdir(self._sep.join([self.root, path]))
+                except OSError:
+                    pass
                 else:
-                    raise ValueError
+                    journal.pop(path + self._sep, None)
+            if stale:
+                self._forget_dirs()
+            self._manifest_dirs = wanted_dirs
 
-                path = convert_path(filepath.lstrip('/'))
-                path = self._sep.join([self.root, path])
-                parent = dirname(path)
-                if not isdir(parent):
-                    os.makedirs(parent)
+            self._build(dirs, changed, workers)
+        finally:
+            self._drop_dir_fds()
 
-                if should_dedent:
-                    contents = dedent(contents)
 
-                if not is_bytestring(contents):
-                    contents = contents.encode(encoding)
+    def _undo_unwanted(self, wanted, wanted_dirs):
+        """Delete the files and (empty) directories in the journal that aren't
+        in ``wanted`` or ``wanted_dirs``, newest first.
+        """
+        sep = self._sep
+        journal = self._journal()
+        kept = []
+        for path in reversed(journal):
+            is_dir = path.endswith(sep)
+            if (path[:-len(sep)] in wanted_dirs) if is_dir else (path in wanted):
+                kept.append(path)
+                continue
+            full = sep.join([self.root, path])
+            try:
+                if is_dir:
+                    os.rmdir(full)
+                else:
+                    os.unlink(full)
+            except OSError as exc:
+                if exc.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+        journal.clear()
+        journal.extend(reversed(kept))
+
 
-                with open(path, 'wb+') as f:
-                    f.write(contents)
+    def _stat_record(self, path, digest):
+        """Return a manifest record for the file at ``path`` as it is on disk,
+        or ``None`` if it's not there.
+        """
+        try:
+            st = os.lstat(self._sep.join([self.root, path]))
+        except OSError:
+            return None
+        return (st.st_size, digest, getattr(st, 'st_mtime_ns', st.st_mtime))
 
-            else:
-                raise TypeError
+
+    def _journal(self):
+        """Return the :py:class:`_Journal` of paths (relative to
+        :py:attr:`root`) that :py:func:`mk` created, with directories ending in
+        the path separator, starting over if :py:attr:`root` has changed.
+        """
+        if self._journal_root != self.root:
+            self._journal_cache = _Journal()
+            self._journal_root = self.root
+        return self._journal_cache
+
+
+    def _known_dirs(self):
+        """Return the set of directories (relative to :py:attr:`root`) that we
+        know exist, starting over if :py:attr:`root` has changed.
+        """
+        if self._known_dirs_root != self.root:
+            self._known_dirs_cache = set()
+            self._made_dirs_cache = set()
+            self._known_dirs_root = self.root
+        return self._known_dirs_cache
+
+
+    def _forget_dirs(self):
+        self._known_dirs_cache = set()
+        self._made_dirs_cache = set()
+        self._known_dirs_root = None
+        self._resolved_root = None
+        if self._dir_fds_root is not None:
+            _close_dir_fds(-1, self._subdir_fds)
+
+
+    def _root_dir_fd(self):
+        """Return a descriptor for :py:attr:`root`, opening it if
+        :py:attr:`root` has changed, or ``None`` where the platform can't work
+        relative to one (or :py:attr:`root` isn't there).
+
+        Directories are made and files opened relative to it, so the kernel
+        doesn't walk from ``/`` for each one, and :py:func:`mk` keeps working
+        on the same directory if :py:attr:`root` is renamed. The descriptors
+        are closed before the call that opened them returns, so a tree that
+        isn't busy holds none open.
+
+        """
+        if not _dir_fds_supported:
+            return None
+        if self._dir_fds_root != self.root:
+            self._drop_dir_fds()
+            try:
+                fd = os.open(self.root, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+            except OSError:
+                return None
+            self._root_fd, self._subdir_fds = fd, collections.OrderedDict()
+            self._dir_fds_root = self.root
+        return self._root_fd
+
+
+    def _drop_dir_fds(self):
+        if self._dir_fds_root is not None:
+            _close_dir_fds(self._root_fd, self._subdir_fds)
+            self._dir_fds_root = None
+
+
+    def _open_at(self, path, cached_dirs):
+        """Return a descriptor and a path relative to it to open the file at
+        ``path`` (relative to :py:attr:`root`) with, or ``(None, None)``.
+        """
+        root_fd = self._root_dir_fd()
+        if root_fd is None:
+            return None, None
+        if not cached_dirs or self.dir_fds < 1:
+            return root_fd, path
+        parent, name = os.path.split(path)
+        if not parent:
+            return root_fd, path
+        fds = self._subdir_fds
+        fd = fds.pop(parent, None)
+        if fd is None:
+            fd = os.open(parent, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0), dir_fd=root_fd)
+            while len(fds) >= self.dir_fds:
+                os.close(fds.popitem(last=False)[1])
+        fds[parent] = fd  # most recently used goes last
+        return fd, name
+
+
+    def _make_dirs(self, paths, recheck=()):
+        """Make sure the directories at ``paths`` (relative to :py:attr:`root`) exist.
+
+        Each distinct directory is checked at most once per tree, except for
+        those in ``recheck``: directories asked for in their own right, which
+        no file write would notice had gone missing. Deepest paths go first,
+        so one :py:func:`os.makedirs` also covers their ancestors.
+
+        """
+        recheck = set(recheck)
+        known = self._known_dirs()
+        observer = self.observer
+        root_fd = self._root_dir_fd()
+        syscalls = made = 0
+        for path in sorted(set(paths), reverse=True):
+            if path in known and path not in recheck:
+                continue
+            if observer is not None:
+                start = _clock()
+            try:
+                n = self._make_dir(path, root_fd)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT or root_fd is None:
+                    raise
+                # Someone removed the root behind our back.
+                self._drop_dir_fds()
+                root_fd = None
+                n = self._make_dir(path, root_fd)
+            syscalls += 1 + n
+            made += n
+            if n:
+                self._made(path, n)
+                if observer is not None:
+                    observer(Event('mkdir', path, None, _clock() - start))
+            while path not in known:
+                known.add(path)
+                path = dirname(path)
+        if syscalls:
+            self._tally(syscalls, dirs_created=made)
+
+
+    def _made(self, path, n):
+        """Note that we made the directory at ``path`` and the ``n - 1``
+        nearest of its parents, so they're real directories, not symlinks, and
+        they go in the journal.
+
+        Directories only count as made if all of their parents do too, so
+        :py:func:`resolve` can trust a whole path by looking at its parent.
+
+        """
+        self._known_dirs()  # starts over if root has changed
+        made, journal = self._made_dirs_cache, self._journal()
+        chain = []
+        for i in range(n):
+            chain.append(path)
+            path = dirname(path)
+        for path in reversed(chain):
+            if path:
+                journal.append(path + self._sep)
+            if path and (dirname(path) == '' or dirname(path) in made):
+                made.add(path)
+
+
+    def _make_dir(self, path, root_fd):
+        """Make the directory at ``path`` (relative to :py:attr:`root`) and any
+        parents unless it exists, returning how many directories were made.
+        """
+        if root_fd is not None and not path:
+            return 0  # it's open, so it's there
+        if root_fd is None:
+            full = self._sep.join([self.root, path])
+            return 0 if isdir(full) else _makedirs(full)
+        return 0 if _isdir(path, root_fd) else _makedirs(path, root_fd)
+
+
+    def _write_file(self, path, contents, should_dedent, encoding, cached_dirs=False):
+        """Write one file from a parsed treedef; its parent must already exist.
+        Pass ``cached_dirs=True`` to open it relative to a cached descriptor
+        for its parent, which is only safe from one thread.
+        """
+        if _is_text(contents):
+            contents = self._encode(contents, should_dedent, encoding, path)
+
+        observer = self.observer
+        if observer is not None:
+            start = _clock()
+        syscalls = 3  # open, write, close
+        full = self._sep.join([self.root, path])
+        replaced = False
+        if self._hardlinked_root == self.root and path in self._hardlinked_cache:
+            self._hardlinked_cache.discard(path)
+            replaced = _unlink(full)  # don't write through to the content store
+            syscalls += 1
+        try:
+            dir_fd, relpath = self._open_at(path, cached_dirs)
+            f, created = _create(full if dir_fd is None else relpath, dir_fd)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            # Someone removed a directory behind our back.
+            self._forget_dirs()
+            made = _makedirs(dirname(full))
+            self._made(dirname(path), made)
+            self._tally(made + 1, dirs_created=made)
+            f, created = _create(full)
+        if created and not replaced:
+            self._journal().append(path)
+        with f:
+            written = _write_contents(f, contents, encoding, self.chunk_size)
+            if self._manifest is not None:
+                f.flush()
+                st = os.fstat(f.fileno())
+                syscalls += 1
+                digest = _digest(contents)
+                self._manifest[path] = (st.st_size, digest, getattr(st, 'st_mtime_ns', st.st_mtime))
+        self._tally(syscalls, files_written=1, bytes_written=written)
+        if observer is not None:
+            observer(Event('write', path, written, _clock() - start))
 
 
     def resolve(self, path=''):
@@ -256,19 +2145,910 @@ class FilesystemTree(object):
         The return value of :py:func:`resolve` with no arguments is equivalent
         to :py:attr:`root`.
 
+        Removing symlinks costs a system call per directory in the path, so
+        the tree takes some shortcuts: it only works out the real path of
+        :py:attr:`root` once (until :py:attr:`root` changes), and paths inside
+        directories that :py:func:`mk` made itself are joined on to it
+        without looking at anything but the last part of the path. Those
+        results are remembered, up to :py:attr:`resolve_cache_size` of them,
+        until :py:func:`remove` or :py:func:`reset` deletes directories (or
+        :py:attr:`root` changes). Anything else, such as a path with ``..``
+        in it, goes through :py:func:`os.path.realpath`. So if the code under
+        test swaps something :py:func:`mk` made for a symlink, paths through
+        it that were resolved before may come out stale.
+
+        """
+        if self._resolved_root != self.root:
+            self._real_root = realpath(self.root)
+            self._resolve_memo = {}
+            self._resolved_root = self.root
+        memo = self._resolve_memo
+        resolved = memo.get(path)
+        if resolved is not None:
+            return resolved
+
+        parts = [part for part in path.split('/') if part]
+        if not parts:
+            return self._real_root
+        if '.' not in parts and '..' not in parts:
+            relpath = self._sep.join(parts)
+            parent = dirname(relpath)
+            self._known_dirs()  # starts over if root has changed
+            made = self._made_dirs_cache
+            if relpath in made or parent == '' or parent in made:
+                resolved = self._sep.join([self._real_root, relpath])
+                if relpath in made or not islink(resolved):
+                    if len(memo) >= self.resolve_cache_size:
+                        memo.pop(next(iter(memo)), None)  # the oldest, or thereabouts
+                    memo[path] = resolved
+                    return resolved
+        return realpath(self._sep.join([self.root] + path.split('/')))
+
+
+    def resolve_many(self, paths):
+        """Return a list of the results of :py:func:`resolve` for each of ``paths``.
         """
-        path = self._sep.join([self.root] + path.split('/'))
-        return realpath(path)
+        resolve = self.resolve
+        return [resolve(path) for path in paths]
 
 
-    def remove(self):
+    def remove(self, background=None, created_only=False):
         """Remove the filesystem tree at :py:attr:`root`.
 
+        :param bool background: Whether to move the tree out of the way and
+            delete it on a background thread, rather than delete it before
+            returning. If not specified, :py:attr:`remove_in_background` is
+            used.
+
+        :param bool created_only: Set to ``True`` to only delete what
+            :py:func:`mk` created, with :py:func:`undo`
+
+        :returns: ``None``, or a :py:class:`Removal` when removing in the
+            background
+
+        A tree removed in the background is first renamed into a graveyard
+        directory next to :py:attr:`root` (``.filesystem-tree-graveyard-``
+        plus the process ID), so :py:attr:`root` is gone as soon as this
+        returns. Call :py:func:`Removal.wait` if you need the disk space back
+        before you go on. Graveyards are emptied before the process exits, and
+        graveyards left behind by processes that died are swept up the next
+        time a tree is removed in the background beside them. If the tree
+        can't be renamed (if it's a mount point, say), it's removed in the
+        foreground instead.
+
+        A tree from a :py:class:`FilesystemTreePool` goes back to the pool
+        instead.
+
+        """
+        if self._pool is not None:
+            return self._pool.release(self)
+        if created_only:
+            return self.undo()
+        if background is None:
+            background = self.remove_in_background
+        self._forget_dirs()
+        self._drop_dir_fds()
+        self._manifest = None
+        self._hardlinked_root = None
+        self._written_blobs_root = None
+        self._journal_root = None
+        if not isdir(self.root):
+            return None
+        observer = self.observer
+        if observer is not None:
+            start = _clock()
+        self._tally(1, removals=1)
+        removal = _bury(self.root) if background else None
+        if removal is None:
+            _rmtree(self.root, self.remove_workers)
+        if observer is not None:
+            observer(Event('remove', '', None, _clock() - start))
+        return removal
+
+
+    def snapshot(self, include=None, exclude=None):
+        """Read the tree back, yielding a treedef for it.
+
+        :param include: A glob (or a sequence of them) that paths must match
+            to be included; all are, if not specified
+
+        :param exclude: A glob (or a sequence of them) for paths to leave
+            out; directories that match are skipped along with everything in
+            them
+
+        :returns: a generator of treedef items, as for :py:func:`mk`
+
+        Directories come out as strings and files as ``(path, contents)``
+        tuples, with ``/`` as the separator, in order by name, directories
+        before what's in them. The contents are :py:class:`LazyFile` objects,
+        so nothing is read until you ask for it, and a snapshot of even a huge
+        tree costs little memory. Globs match the whole path relative to
+        :py:attr:`root`, and ``*`` matches across ``/``. The content store in
+        :py:attr:`blob_dir` is left out.
+
+        >>> ft = FilesystemTree(('path/to/file.txt', 'Greetings, program!'))
+        >>> for item in ft.snapshot():
+        ...     print(item)  # doctest: +ELLIPSIS
+        path
+        path/to
+        (...'path/to/file.txt', <LazyFile ...file.txt'>)
+        >>> print(dict(ft.snapshot(include='*.txt'))['path/to/file.txt'].read().decode('UTF-8'))
+        Greetings, program!
+
+        Feeding a snapshot back to :py:func:`mk` copies the files as they are
+        on disk then (never dedenting them), so it round-trips:
+
+        >>> copy = FilesystemTree(*ft.snapshot())
+        >>> open(copy.resolve('path/to/file.txt')).read()
+        'Greetings, program!'
+
+        Only regular files and directories are included, and symlinks to
+        directories aren't followed.
+
+        """
+        stack = ['']
+        while stack:
+            top = stack.pop()
+            full = self._sep.join([self.root] + top.split('/')) if top else self.root
+            subdirs = []
+            for name, is_dir, is_file, stat in _list_dir(full):
+                path = top + '/' + name if top else name
+                if path == self.blob_dir:
+                    continue
+                if exclude is not None and _match_any(path, exclude):
+                    continue
+                wanted = include is None or _match_any(path, include)
+                if is_dir:
+                    if wanted:
+                        yield path
+                    subdirs.append(path)
+                elif is_file and wanted:
+                    lazy = LazyFile(self._sep.join([full, name]))
+                    lazy._stat = stat
+                    yield (path, lazy)
+            stack.extend(reversed(subdirs))  # depth first, in order
+
+
+    def diff(self, *treedef, **kw):
+        """Compare the tree with ``treedef``.
+
+        This takes the same arguments as :py:func:`mk`, and the contents in
+        ``treedef`` are dedented and encoded the same way, so they compare
+        equal to what :py:func:`mk` would have written. The tree is walked
+        once, as by :py:func:`snapshot`, and then only the files whose size on
+        disk (as the walk found it) matches what's expected are read and
+        hashed, a chunk at a time; with ``workers`` greater than one, that
+        happens on a pool of threads. (Streamed contents have no size to go
+        by, so those files are always hashed.) A directory where a file is
+        expected, or the other way around, is both added and removed.
+
+        :returns: a :py:class:`TreeDiff`
+
+        >>> ft = FilesystemTree(('a.txt', 'a'), ('b.txt', 'b'))
+        >>> print(ft.diff(('a.txt', 'A'), ('c.txt', 'c')))
+        + b.txt
+        - c.txt
+        ~ a.txt
+
+        """
+        should_dedent = kw.get('should_dedent', self.should_dedent)
+        encoding = kw.get('encoding', self.encoding)
+        workers = kw.get('workers', self.workers)
+
+        dirs, files = _parse_treedef(treedef, should_dedent, encoding, '/')
+        expected = {}
+        for path in dirs + [posixpath.dirname(f[0]) for f in files]:
+            while path and path not in expected:
+                expected[path] = None
+                path = posixpath.dirname(path)
+        for path, contents, should_dedent, encoding in files:
+            if _is_text(contents):
+                contents = self._encode(contents, should_dedent, encoding)
+            expected[path] = (contents, encoding)
+
+        added, changed, candidates, actual = [], [], [], set()
+        for item in self.snapshot():
+            if not isinstance(item, tuple):
+                if expected.get(item, False) is None:
+                    actual.add(item)
+                else:
+                    added.append(item)  # not expected, or expected to be a file
+                continue
+            path, lazy = item
+            want = expected.get(path)
+            if want is None:
+                added.append(path)
+                continue
+            actual.add(path)
+            contents, encoding = want
+            size = _contents_size(contents)
+            if size is not None and lazy.size != size:
+                changed.append(path)
+            else:
+                candidates.append((path, lazy.path, contents, encoding))
+        removed = [path for path in expected if path not in actual]
+
+        differs = lambda candidate: self._differs(*candidate[1:])
+        if ThreadPoolExecutor is None or workers is None or workers < 2 or len(candidates) < 2:
+            results = map(differs, candidates)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(differs, candidates))
+        changed.extend(c[0] for c, result in zip(candidates, results) if result)
+        return TreeDiff(sorted(added), sorted(removed), sorted(changed))
+
+
+    def _differs(self, full, contents, encoding):
+        """Return whether the file at ``full`` differs from prepared ``contents``.
+        """
+        with open(full, 'rb') as f:
+            actual = _hash_chunks(iter(partial(f.read, self.chunk_size), b''))
+        return actual != _hash_chunks(_iter_contents(contents, encoding, self.chunk_size))
+
+
+    def assert_matches(self, *treedef, **kw):
+        """Like :py:func:`diff`, but raise :py:exc:`AssertionError` if there
+        are any differences, with the :py:class:`TreeDiff` as its message.
+        """
+        diff = self.diff(*treedef, **kw)
+        if diff:
+            raise AssertionError('tree at {0} differs from treedef:\n{1}'.format(self.root, diff))
+
+
+    def mk_from_archive(self, archive):
+        """Extract a tar or zip archive into the tree.
+
+        :param archive: The path of the archive, or a binary file object to
+            read it from
+
+        :raises: :py:exc:`ValueError`, if a member's path leads outside
+            :py:attr:`root`, or a hard link's target wasn't extracted before
+            it (raised when that member is reached)
+
         :returns: ``None``
 
+        Members are streamed to disk one at a time, in archive order, so this
+        takes little memory however big the archive is, and tarballs
+        (compressed or not) can come from a stream that can't seek, like a
+        pipe. Paths are taken relative to :py:attr:`root` the same way
+        :py:func:`mk` takes them, so a leading ``/`` is dropped; members with
+        ``..`` in their path are refused. Only directories, regular files,
+        and hard links are extracted (not symlinks or devices, say); a hard
+        link becomes a copy of the file it links to, which must come earlier
+        in the archive. Contents are written as they are, without dedenting
+        or keeping permissions or modification times.
+
+        """
+        f = archive if hasattr(archive, 'read') else open(archive, 'rb')
+        try:
+            for name, contents in _archive_members(f):
+                path = _archive_path(name)
+                if path is None:
+                    continue
+                path = self._sep.join(path.split('/'))
+                if contents is None:
+                    self._build([path], [], None)
+                elif is_stringy(contents):
+                    target = _archive_path(contents)
+                    source = self._sep.join([self.root] + (target or '').split('/'))
+                    if target is None or not os.path.isfile(source):
+                        raise ValueError('archive member {0!r} links to {1!r}, which '
+                                         "hasn't been extracted".format(name, contents))
+                    self._build([], [(path, Source(source), False, self.encoding)], None)
+                else:
+                    self._build([], [(path, contents, False, self.encoding)], None)
+        finally:
+            self._drop_dir_fds()
+            if f is not archive:
+                f.close()
+
+
+    def export_archive(self, archive, format='tar', include=None, exclude=None):
+        """Write the tree to a tar or zip archive.
+
+        :param archive: The path of the archive to write, or a binary file
+            object to write it to
+
+        :param str format: One of ``'tar'``, ``'gztar'``, ``'bztar'``,
+            ``'xztar'``, or ``'zip'``, as for :py:func:`shutil.make_archive`
+
+        :param include: Passed to :py:func:`snapshot`
+
+        :param exclude: Passed to :py:func:`snapshot`
+
+        :returns: ``None``
+
+        Each file is streamed into the archive a chunk at a time, and
+        tarballs are written as a stream, so ``archive`` may be a pipe or a
+        socket. Zip archives need a file object that can seek. Paths in the
+        archive are relative to :py:attr:`root`, and the content store in
+        :py:attr:`blob_dir` is left out.
+
+        >>> ft = FilesystemTree(('path/to/file.txt', 'Greetings, program!'))
+        >>> archive = io.BytesIO()
+        >>> ft.export_archive(archive, 'gztar')
+        >>> copy = FilesystemTree()
+        >>> copy.mk_from_archive(io.BytesIO(archive.getvalue()))
+        >>> open(copy.resolve('path/to/file.txt')).read()
+        'Greetings, program!'
+
+        """
+        compression = {'tar': '', 'gztar': 'gz', 'bztar': 'bz2', 'xztar': 'xz'}
+        if format != 'zip' and format not in compression:
+            raise ValueError("format must be 'tar', 'gztar', 'bztar', 'xztar', or 'zip'")
+        items = self.snapshot(include=include, exclude=exclude)
+        if format == 'zip':
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as out:
+                for item in items:
+                    if isinstance(item, tuple):
+                        out.write(item[1].path, item[0])
+                    else:
+                        out.write(self._sep.join([self.root] + item.split('/')), item + '/')
+            return
+        f = archive if hasattr(archive, 'write') else open(archive, 'wb')
+        try:
+            with tarfile.open(fileobj=f, mode='w|' + compression[format]) as out:
+                for item in items:
+                    if isinstance(item, tuple):
+                        out.add(item[1].path, item[0], recursive=False)
+                    else:
+                        out.add(self._sep.join([self.root] + item.split('/')), item, recursive=False)
+        finally:
+            if f is not archive:
+                f.close()
+
+
+    def undo(self):
+        """Delete exactly what :py:func:`mk` created, newest first.
+
+        :returns: ``None``
+
+        The tree keeps a journal of the files and directories that
+        :py:func:`mk` (and the methods built on it) created, as opposed to
+        ones that were already there and got overwritten or reused. This
+        deletes those, so with a ``root`` that holds more than the fixture,
+        everything else is left alone, and the work scales with the size of
+        the fixture rather than of :py:attr:`root`:
+
+        >>> ft = FilesystemTree()
+        >>> ft.mk(('existing.txt', 'already here'))
+        >>> ft = FilesystemTree(('new/file.txt', 'new'), ('existing.txt', 'changed'), root=ft.root)
+        >>> ft.undo()
+        >>> print(' '.join(os.listdir(ft.root)))
+        existing.txt
+
+        Files that :py:func:`mk` overwrote are not put back as they were.
+        Directories that aren't empty (because something else was put in
+        them) are left in place, and anything already gone is skipped.
+        :py:attr:`root` itself is deleted too if the tree made it and it ends
+        up empty. The journal starts over when :py:attr:`root` changes and
+        after :py:func:`remove`.
+
+        """
+        journal = self._journal()
+        observer = self.observer
+        if observer is not None:
+            start = _clock()
+        self._forget_dirs()
+        self._drop_dir_fds()
+        self._manifest = None
+        self._hardlinked_root = None
+        self._written_blobs_root = None
+        sep = self._sep
+        paths = [self.root + sep] if self._made_root == self.root else []
+        paths.extend(sep.join([self.root, path]) for path in journal)
+        while paths:
+            full = paths.pop()
+            try:
+                if full.endswith(sep):
+                    os.rmdir(full)
+                else:
+                    os.unlink(full)
+            except OSError as exc:
+                if exc.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+        self._tally(len(journal), removals=1)
+        journal.clear()
+        if observer is not None:
+            observer(Event('remove', '', None, _clock() - start))
+
+
+    def clone(self, root=None, link='auto'):
+        """Return a new :py:class:`FilesystemTree` holding a copy of this one.
+
+        :param string root: The root of the new tree. If not specified or
+            ``None``, a temporary directory will be created and used.
+
+        :param str link: How to copy files: ``'reflink'`` makes copy-on-write
+            clones (and raises :py:exc:`OSError` where the filesystem doesn't
+            support them), ``'hardlink'`` shares the files with this tree (so
+            only use it for fixtures nobody writes to), ``'copy'`` copies the
+            bytes, and ``'auto'`` tries a reflink and falls back to a copy.
+
+        :returns: a new :py:class:`FilesystemTree`
+
+        This lets you build a large tree once and use it as a template, so that
+        each fixture only costs a walk over the template rather than
+        dedenting, encoding, and writing every file again:
+
+        >>> template = FilesystemTree(('path/to/file.txt', 'Greetings, program!'))
+        >>> ft = template.clone()
+        >>> open(ft.resolve('path/to/file.txt')).read()
+        'Greetings, program!'
+        >>> ft.root != template.root
+        True
+
+        """
+        if link not in ('auto', 'reflink', 'hardlink', 'copy'):
+            raise ValueError("link must be 'auto', 'reflink', 'hardlink', or 'copy'")
+        clone = self.__class__( root=root
+                              , should_dedent=self.should_dedent
+                              , encoding=self.encoding
+                              , workers=self.workers
+                              , dedup=self.dedup
+                              , storage=self.storage
+                              , observer=self.observer
+                               )
+        files = _copy_tree(self.root, clone.root, link)
+        if link == 'hardlink':
+            clone._hardlinked().update(files)  # so mk replaces them, not writes through
+        return clone
+
+
+class Plan(object):
+    """A treedef compiled by :py:func:`compile_treedef`, ready to replay.
+
+    Plans can't be changed once they're made. Their attributes are:
+
+    ``dirs``
+        every directory the plan needs, as a sorted tuple of paths relative to
+        the root, using ``/`` as the separator
+
+    ``files``
+        a tuple of ``(path, contents, should_dedent, encoding)`` tuples, with
+        string contents already dedented and encoded
+
+    ``size``
+        roughly how many bytes the files take up
+
+    ``leaves``
+        the directories in ``dirs`` with nothing in the plan inside them,
+        which :py:func:`FilesystemTree.mk` checks for on every replay
+
+    """
+
+    __slots__ = ('dirs', 'files', 'size', 'leaves')
+
+    def __init__(self, dirs, files, size, leaves=()):
+        object.__setattr__(self, 'dirs', dirs)
+        object.__setattr__(self, 'files', files)
+        object.__setattr__(self, 'size', size)
+        object.__setattr__(self, 'leaves', leaves)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('plans are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('plans are immutable')
+
+    def __repr__(self):
+        return '<Plan: {0} dirs, {1} files, {2} bytes>'.format(len(self.dirs), len(self.files), self.size)
+
+
+def compile_treedef(*treedef, **kw):
+    """Do the work of :py:func:`FilesystemTree.mk` that doesn't touch the disk, once.
+
+    :param treedef: The definition of a filesystem tree, as for :py:func:`FilesystemTree.mk`
+
+    :param bool should_dedent: As for :py:func:`FilesystemTree.mk`; defaults
+        to :py:attr:`FilesystemTree.should_dedent`
+
+    :param str encoding: As for :py:func:`FilesystemTree.mk`; defaults to
+        :py:attr:`FilesystemTree.encoding`
+
+    :raises: the same exceptions as :py:func:`FilesystemTree.mk` does for a bad treedef
+
+    :returns: a :py:class:`Plan`
+
+    If you build the same tree many times, compile it once, and pass the plan
+    to :py:func:`FilesystemTree.mk` or :py:class:`FilesystemTree` (or
+    :py:class:`MemoryTree`), alone or alongside other treedef items. The
+    paths are already split and joined, the directories sorted, and the
+    contents dedented and encoded, so replaying the plan only does the I/O:
+
+    >>> plan = compile_treedef(('greetings/program.txt', 'Greetings, program!'))
+    >>> ft = FilesystemTree(plan)
+    >>> open(ft.resolve('greetings/program.txt')).read()
+    'Greetings, program!'
+
+    Streamed contents are kept as they are, so a plan with a generator or
+    file-like object in it can only be replayed once.
+
+    """
+    should_dedent = kw.get('should_dedent', FilesystemTree.should_dedent)
+    encoding = kw.get('encoding', FilesystemTree.encoding)
+
+    dirs, files = _parse_treedef(treedef, should_dedent, encoding, '/')
+    files = tuple( (path, _encode(contents, should_dedent, encoding), False, encoding)
+                   if _is_text(contents) else (path, contents, False, encoding)
+                   for path, contents, should_dedent, encoding in files
+                  )
+    needed = set()
+    for path in dirs + [posixpath.dirname(f[0]) for f in files]:
+        while path not in needed:
+            needed.add(path)
+            path = posixpath.dirname(path)
+    parents = set(posixpath.dirname(path) for path in list(needed) + [f[0] for f in files])
+    leaves = tuple(sorted(needed - parents - set([''])))
+    return Plan(tuple(sorted(needed, reverse=True)), files, _estimate_size(files), leaves)
+
+
+class FilesystemTreePool(object):
+    """Keep temporary roots ready for :py:class:`FilesystemTree` objects.
+
+    :param int size: How many empty (or template-populated) roots to keep ready
+
+    :param FilesystemTree template: A tree to :py:func:`~FilesystemTree.clone`
+        into each root before handing it out
+
+    :param int max_roots: The most roots the pool will have on disk at once,
+        counting those handed out; when that many are out, :py:func:`acquire`
+        waits for one to come back. ``None`` means no limit.
+
+    :param kw: Passed through to :py:class:`FilesystemTree` (``should_dedent``,
+        ``encoding``, ``workers``, and ``storage``)
+
+    Making a temporary directory is on the critical path of every fixture. A
+    pool does that work ahead of time on a background thread, and recycles
+    roots when they're removed, emptying them in the background too:
+
+    >>> pool = FilesystemTreePool(size=2)
+    >>> ft = pool.acquire(('greetings/program.txt', 'Greetings, program!'))
+    >>> open(ft.resolve('greetings/program.txt')).read()
+    'Greetings, program!'
+    >>> ft.remove()  # back to the pool
+    >>> pool.close()
+
+    :py:func:`acquire` takes the same arguments as :py:class:`FilesystemTree`
+    (except ``root``), and calling the pool is the same as calling
+    :py:func:`acquire`, so a pool can stand in for the class. The trees it
+    hands out are ordinary :py:class:`FilesystemTree` objects, except that
+    :py:func:`~FilesystemTree.remove` returns them to the pool; use them as
+    context managers as usual. Don't use a tree after removing it, since its
+    root may already belong to someone else. A pool is safe to share between
+    threads.
+
+    """
+
+    tree_class = FilesystemTree  #: The class of the trees the pool hands out.
+
+    def __init__(self, size=4, template=None, max_roots=None, **kw):
+        self.size = size
+        self.template = template
+        self.max_roots = max_roots
+        self.kw = kw
+        self._idle = collections.deque()
+        self._dirty = collections.deque()
+        self._out = {}  # handed-out roots, and the trees they were handed out to
+        self._count = 0  # roots on disk or on their way there
+        self._closed = False
+        self._cond = threading.Condition()
+        self._worker = threading.Thread(target=self._work, name='filesystem-tree-pool')
+        self._worker.daemon = True
+        self._worker.start()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+    def acquire(self, *treedef, **kw):
+        """Return a :py:class:`FilesystemTree` with a root from the pool.
+
+        :param treedef: Passed through to :py:func:`~FilesystemTree.mk`
+
+        :param kw: Override the pool's keyword arguments for :py:class:`FilesystemTree`
+
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise ValueError('the pool is closed')
+                if self._idle:
+                    root = self._idle.popleft()
+                    break
+                if self.max_roots is None or self._count < self.max_roots:
+                    root = None
+                    self._count += 1
+                    break
+                self._cond.wait()
+            self._cond.notify_all()  # time to top up
+        if root is None:
+            try:
+                root = self._make_root()
+            except BaseException:
+                with self._cond:
+                    self._count -= 1
+                    self._cond.notify_all()
+                raise
+        with self._cond:
+            self._out[root] = None
+        options = dict(self.kw, **kw)
+        try:
+            tree = self.tree_class(*treedef, root=root, **options)
+        except BaseException:
+            self._give_back(root, None)  # a bad treedef mustn't leak the root
+            raise
+        with self._cond:
+            self._out[root] = tree
+        tree._pool = self
+        return tree
+
+    __call__ = acquire
+
+
+    def release(self, tree):
+        """Take back a tree's root, to empty it in the background and hand it
+        out again. :py:func:`FilesystemTree.remove` calls this for you.
+        Releasing a tree twice does nothing, even once its root has been
+        handed out again.
+        """
+        tree._forget_dirs()
+        tree._drop_dir_fds()
+        return self._give_back(tree.root, tree)
+
+
+    def _give_back(self, root, tree):
+        """Queue ``root``, if it's still handed out to ``tree``, to be emptied
+        and reused, or remove it if the pool is closed.
+        """
+        with self._cond:
+            if root not in self._out or self._out[root] is not tree:
+                return None
+            del self._out[root]
+            if not self._closed:
+                self._dirty.append(root)
+                self._cond.notify_all()
+                return None
+            self._count -= 1
+        if isdir(root):
+            _rmtree(root)
+
+
+    def close(self):
+        """Stop making roots and remove the idle ones. Roots that are handed
+        out are removed when they're released.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join()
+        with self._cond:
+            idle, self._idle = list(self._idle), collections.deque()
+            self._count -= len(idle)
+        for root in idle:
+            if isdir(root):
+                _rmtree(root)
+
+
+    def _make_root(self):
+        kw = dict((k, v) for k, v in self.kw.items() if k == 'storage')
+        if self.template is not None:
+            return self.template.clone(**kw).root
+        return self.tree_class(**kw).root
+
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not (self._dirty or self._closed or self._wants_more()):
+                    self._cond.wait()
+                if self._dirty:
+                    root, recycle = self._dirty.popleft(), True
+                elif self._closed:
+                    return
+                else:
+                    root, recycle = None, False
+                    self._count += 1
+            try:
+                if recycle:
+                    _rmtree(root, keep_root=True)
+                    if self.template is not None:
+                        self.template.clone(root=root)
+                else:
+                    root = self._make_root()
+            except Exception:
+                with self._cond:
+                    self._count -= 1
+                    self._cond.notify_all()
+                if root is not None and isdir(root):
+                    shutil.rmtree(root, ignore_errors=True)
+                continue
+            with self._cond:
+                self._idle.append(root)
+                self._cond.notify_all()
+
+
+    def _wants_more(self):
+        if len(self._idle) >= self.size:
+            return False
+        return self.max_roots is None or self._count < self.max_roots
+
+
+class MemoryTree(object):
+    """Represent a filesystem tree that lives entirely in memory.
+
+    :param treedef: Any positional arguments are passed through to :py:func:`mk`.
+
+    :param string root: The path that :py:func:`resolve` puts in front of
+        paths in the tree. Defaults to ``/``. (May only be supplied as a keyword
+        argument.)
+
+    :param bool should_dedent: As for :py:class:`FilesystemTree`.
+
+    :param str encoding: As for :py:class:`FilesystemTree`.
+
+    This has the same :py:func:`mk`, :py:func:`resolve`, and :py:func:`remove`
+    methods as :py:class:`FilesystemTree`, and works as a context manager the
+    same way, but never touches the disk. It's for code that takes an
+    injectable filesystem layer, which you can build on the :py:func:`read`,
+    :py:func:`listdir`, :py:func:`stat`, and :py:func:`walk` methods:
+
+    >>> mt = MemoryTree(('path/to/file.txt', 'Greetings, program!'))
+    >>> print(mt.read('path/to/file.txt').decode('UTF-8'))
+    Greetings, program!
+    >>> print(' '.join(mt.listdir('path/to')))
+    file.txt
+
+    Directories are stored as dicts and files as bytestrings in
+    :py:attr:`tree`.
+
+    """
+
+    root = '/'                  #: The path that :py:func:`resolve` puts in front of paths in the tree.
+    should_dedent = True        #: Whether or not to automatically dedent file contents on write.
+    encoding = 'UTF-8'          #: How to encode file contents on write, when necessary.
+    tree = None                 #: A dict mapping names to dicts (directories) and bytestrings (files).
+    content_cache = FilesystemTree.content_cache  #: As for :py:class:`FilesystemTree`.
+
+
+    def __init__(self, *treedef, **kw):
+        self.root = kw.get('root', self.root)
+        self.should_dedent = kw.get('should_dedent', self.should_dedent)
+        self.encoding = kw.get('encoding', self.encoding)
+        self.tree = {}
+        self.mk(*treedef)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type == None and exc_value == None and tb == None:
+            self.remove()
+
+
+    def mk(self, *treedef, **kw):
+        """Builds a filesystem tree in :py:attr:`tree` based on ``treedef``.
+
+        This takes the same arguments as :py:func:`FilesystemTree.mk`, except
+        ``workers``.
+
+        """
+        should_dedent = kw.get('should_dedent', self.should_dedent)
+        encoding = kw.get('encoding', self.encoding)
+
+        dirs, files = _parse_treedef(treedef, should_dedent, encoding, '/')
+        for path in dirs:
+            self._dir(path, create=True)
+        for path, contents, should_dedent, encoding in files:
+            parent, name = self._split(path)
+            parent = self._dir(parent, create=True)
+            if isinstance(parent.get(name), dict):
+                raise OSError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+            if _is_text(contents):
+                cache = self.content_cache
+                if cache is None:
+                    parent[name] = _encode(contents, should_dedent, encoding)
+                else:
+                    parent[name] = cache.encode(contents, should_dedent, encoding)
+            else:
+                buf = io.BytesIO()
+                _write_contents(buf, contents, encoding, FilesystemTree.chunk_size)
+                parent[name] = buf.getvalue()
+
+
+    def resolve(self, path=''):
+        """Given a relative path, return an absolute path.
+
+        :param path: A path relative to :py:attr:`root` using ``/`` as the separator
+
+        :returns: An absolute path using ``/`` as the separator
+
+        """
+        return posixpath.normpath(posixpath.join(self.root, path.lstrip('/')))
+
+
+    def remove(self):
+        """Empty the tree.
+
+        :returns: ``None``
+
+        """
+        self.tree = {}
+
+
+    def read(self, path):
+        """Return the contents of the file at ``path`` as a bytestring.
+        """
+        parent, name = self._split(path)
+        contents = self._dir(parent).get(name)
+        if contents is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if isinstance(contents, dict):
+            raise OSError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+        return contents
+
+
+    def listdir(self, path=''):
+        """Return a sorted list of the names in the directory at ``path``.
+        """
+        return sorted(self._dir(path))
+
+
+    def stat(self, path=''):
+        """Return an :py:class:`os.stat_result` for ``path``.
+
+        Only ``st_mode``, ``st_nlink``, and ``st_size`` are filled in.
+
+        """
+        parent, name = self._split(path)
+        node = self._dir(parent).get(name) if name else self.tree
+        if node is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if isinstance(node, dict):
+            mode, size = S_IFDIR | 0o755, 0
+        else:
+            mode, size = S_IFREG | 0o644, len(node)
+        return os.stat_result((mode, 0, 0, 1, 0, 0, size, 0, 0, 0))
+
+
+    def walk(self, path=''):
+        """Like :py:func:`os.walk`, yielding ``(dirpath, dirnames, filenames)``
+        top-down, with ``dirpath`` relative to :py:attr:`root`.
         """
-        if isdir(self.root):
-            shutil.rmtree(self.root)
+        node = self._dir(path)
+        dirnames = sorted(name for name in node if isinstance(node[name], dict))
+        filenames = sorted(name for name in node if not isinstance(node[name], dict))
+        yield path, dirnames, filenames
+        for name in dirnames:
+            for step in self.walk(posixpath.join(path, name) if path else name):
+                yield step
+
+
+    def _split(self, path):
+        parts = [part for part in path.strip('/').split('/') if part]
+        return '/'.join(parts[:-1]), parts[-1] if parts else ''
+
+
+    def _dir(self, path, create=False):
+        node = self.tree
+        for part in path.strip('/').split('/'):
+            if not part:
+                continue
+            if part not in node and create:
+                node[part] = {}
+            node = node.get(part)
+            if node is None:
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            if not isinstance(node, dict):
+                raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        return node
 
 
 if __name__ == '__main__':
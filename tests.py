@@ -1,10 +1,23 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import errno
+import io
 import os
+import stat
+import sys
+import tarfile
+import tempfile
+import zipfile
 from os.path import isdir
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import filesystem_tree
 import pytest
-from filesystem_tree import FilesystemTree
+from filesystem_tree import ContentCache, Event, FilesystemTree, FilesystemTreePool, LazyFile, MemoryTree, Plan, Sized, Source, TreeDiff, compile_treedef
 
 
 @pytest.yield_fixture
@@ -261,5 +274,1386 @@ def test_context_manager_doesnt_remove_on_exception_context_exit():
     assert os.path.exists(ftname)
 
 
+# workers
+
+def test_mk_with_workers_makes_files(fs):
+    fs.mk(*[('dir%d/file%d.txt' % (i % 3, i), 'file %d' % i) for i in range(20)], workers=4)
+    for i in range(20):
+        assert open(fs.resolve('dir%d/file%d.txt' % (i % 3, i))).read() == 'file %d' % i
+
+def test_mk_with_workers_via_constructor():
+    fs = FilesystemTree(('a.txt', 'a'), ('b/b.txt', 'b'), workers=2)
+    try:
+        assert fs.workers == 2
+        assert open(fs.resolve('b/b.txt')).read() == 'b'
+    finally:
+        fs.remove()
+
+def test_mk_raises_type_error_before_writing_anything(fs):
+    with pytest.raises(TypeError):
+        fs.mk('some/dir', ('file.txt', 'contents'), 42, workers=2)
+    assert os.listdir(fs.root) == []
+
+def test_mk_raises_value_error_before_writing_anything(fs):
+    with pytest.raises(ValueError):
+        fs.mk(('file.txt', 'contents'), ('bad.txt',))
+    assert os.listdir(fs.root) == []
+
+def test_mk_with_workers_raises_first_error_in_treedef_order(fs):
+    with pytest.raises(UnicodeEncodeError):
+        fs.mk(('ok.txt', 'fine'), ('bad1.txt', '\u2603', 0, 'ascii'), ('bad2.txt', 'hi', 0, 'no-such-codec'), workers=4)
+
+def test_mk_doesnt_leak_tuple_options_to_later_files(fs):
+    fs.mk(('a.txt', '    a', 0), ('b.txt', '    b'))
+    assert open(fs.resolve('b.txt')).read() == 'b'
+
+
+# known directories - kd
+
+def count_isdir(fs, monkeypatch):
+    calls = []
+    def isdir(path):
+        calls.append(path)
+        return os.path.isdir(path)
+    _isdir = filesystem_tree._isdir
+    def isdir_at(path, dir_fd=None):
+        calls.append(path if dir_fd is None else os.sep.join([fs.root, path]))
+        return _isdir(path, dir_fd)
+    monkeypatch.setattr(filesystem_tree, 'isdir', isdir)
+    monkeypatch.setattr(filesystem_tree, '_isdir', isdir_at)
+    return calls
+
+def test_kd_checks_each_directory_once(fs, monkeypatch):
+    calls = count_isdir(fs, monkeypatch)
+    fs.mk(*[('some/dir/file%d.txt' % i, 'hi') for i in range(10)])
+    fs.mk(('some/dir/another.txt', 'hi'))
+    assert calls == [os.sep.join([fs.root, 'some', 'dir'])]
+
+def test_kd_checks_directory_items_every_time(fs, monkeypatch):
+    fs.mk(('some/dir/file.txt', 'hi'))
+    calls = count_isdir(fs, monkeypatch)
+    fs.mk('some', ('some/dir/another.txt', 'hi'))
+    assert calls == [os.sep.join([fs.root, 'some'])]
+
+def test_kd_are_forgotten_on_remove(fs):
+    fs.mk('some/dir')
+    fs.remove()
+    fs.mk('some/dir')
+    assert isdir(fs.resolve('some/dir'))
+
+def test_kd_are_forgotten_when_root_changes(fs):
+    fs.mk('some/dir')
+    other = FilesystemTree()
+    try:
+        fs.root = other.root
+        fs.mk('some/dir')
+        assert isdir(other.resolve('some/dir'))
+    finally:
+        other.remove()
+
+def test_kd_recover_when_a_directory_disappears(fs):
+    import shutil
+    fs.mk(('some/dir/file.txt', 'hi'))
+    shutil.rmtree(fs.resolve('some'))
+    fs.mk(('some/dir/file.txt', 'again'))
+    assert open(fs.resolve('some/dir/file.txt')).read() == 'again'
+
+def test_kd_recover_when_an_explicit_directory_disappears(fs):
+    import shutil
+    fs.mk('a/', 'b/c')
+    shutil.rmtree(fs.resolve('a'))
+    shutil.rmtree(fs.resolve('b'))
+    fs.mk('a/', 'b/c')
+    assert isdir(fs.resolve('a'))
+    assert isdir(fs.resolve('b/c'))
+
+def test_kd_recover_when_a_planned_directory_disappears(fs):
+    import shutil
+    plan = compile_treedef('a/b', ('c/d.txt', 'd'))
+    assert plan.leaves == ('a/b',)
+    fs.mk(plan)
+    shutil.rmtree(fs.resolve('a'))
+    fs.mk(plan)
+    assert isdir(fs.resolve('a/b'))
+
+
+# storage
+
+def test_storage_disk_parses_the_treedef_once(monkeypatch):
+    calls = []
+    parse = filesystem_tree._parse_treedef
+    monkeypatch.setattr(filesystem_tree, '_parse_treedef', lambda *a: calls.append(1) or parse(*a))
+    FilesystemTree(('a.txt', 'a')).remove()
+    assert len(calls) == 1
+
+def test_storage_defaults_to_disk(fs):
+    assert fs.storage == 'disk'
+    assert os.path.dirname(fs.root) == os.path.realpath(tempfile.gettempdir())
+
+def test_storage_auto_uses_ram_when_available():
+    fs = FilesystemTree(('file.txt', 'hi'), storage='auto')
+    try:
+        ram_dirs = [os.path.realpath(d) for d in filesystem_tree._ram_dirs(fs.ram_dirs)]
+        if ram_dirs:
+            assert os.path.dirname(fs.root) == ram_dirs[0]
+        assert open(fs.resolve('file.txt')).read() == 'hi'
+    finally:
+        fs.remove()
+
+def test_storage_auto_falls_back_to_disk_when_ram_is_short(monkeypatch):
+    monkeypatch.setattr(filesystem_tree, '_free_space', lambda path: 10)
+    fs = FilesystemTree(('file.txt', 'hi'), storage='auto')
+    try:
+        assert os.path.dirname(fs.root) == os.path.realpath(tempfile.gettempdir())
+    finally:
+        fs.remove()
+
+def test_storage_ram_raises_without_ram(monkeypatch):
+    monkeypatch.setattr(FilesystemTree, 'ram_dirs', ())
+    with pytest.raises(OSError):
+        FilesystemTree(storage='ram')
+
+def test_storage_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        FilesystemTree(storage='cloud')
+
+def test_storage_is_ignored_when_root_is_given(fs):
+    other = FilesystemTree(root=fs.root, storage='ram')
+    assert other.root == fs.root
+
+
+# asyncio
+
+needs_asyncio = pytest.mark.skipif(filesystem_tree.asyncio is None, reason='needs asyncio')
+
+@pytest.yield_fixture
+def loop():
+    loop = filesystem_tree.asyncio.new_event_loop()
+    filesystem_tree.asyncio.set_event_loop(loop)
+    yield loop
+    filesystem_tree.asyncio.set_event_loop(None)
+    loop.close()
+
+@needs_asyncio
+def test_amk_makes_files(fs, loop):
+    loop.run_until_complete(fs.amk(('some/dir/file.txt', '    hi'), should_dedent=False))
+    assert open(fs.resolve('some/dir/file.txt')).read() == '    hi'
+
+@needs_asyncio
+def test_amk_raises_like_mk(fs, loop):
+    with pytest.raises(TypeError):
+        loop.run_until_complete(fs.amk(42))
+
+@needs_asyncio
+def test_aremove_removes(fs, loop):
+    loop.run_until_complete(fs.aremove())
+    assert not isdir(fs.root)
+
+@needs_asyncio
+def test_async_context_manager_removes_on_clean_exit(loop):
+    ft = loop.run_until_complete(FilesystemTree().__aenter__())
+    loop.run_until_complete(ft.__aexit__(None, None, None))
+    assert not isdir(ft.root)
+
+@needs_asyncio
+def test_async_context_manager_doesnt_remove_on_exception(loop):
+    ft = loop.run_until_complete(FilesystemTree().__aenter__())
+    try:
+        loop.run_until_complete(ft.__aexit__(ValueError, ValueError(), None))
+        assert isdir(ft.root)
+    finally:
+        ft.remove()
+
+@needs_asyncio
+def test_async_calls_share_a_bounded_pool(loop):
+    trees = [FilesystemTree() for i in range(10)]
+    futures = [ft.amk(('file.txt', 'hi')) for ft in trees]
+    loop.run_until_complete(filesystem_tree.asyncio.gather(*futures))
+    assert filesystem_tree._async_executor(1)._max_workers == FilesystemTree.async_workers
+    for ft in trees:
+        ft.remove()
+
+
+# streamed contents
+
+def test_mk_streams_a_generator(fs):
+    fs.mk(('file.txt', ('line %d\n' % i for i in range(3))))
+    assert open(fs.resolve('file.txt')).read() == 'line 0\nline 1\nline 2\n'
+
+def test_mk_streams_a_list_of_bytes(fs):
+    fs.mk(('file.bin', [b'\x00\x01', b'\x02']))
+    assert open(fs.resolve('file.bin'), 'rb').read() == b'\x00\x01\x02'
+
+def test_mk_streams_a_file_like_object(fs):
+    import io
+    fs.chunk_size = 3
+    fs.mk(('file.txt', io.StringIO('    Greetings, program!')))
+    assert open(fs.resolve('file.txt')).read() == '    Greetings, program!'
+
+def test_mk_encodes_streamed_text_incrementally(fs):
+    fs.mk(('file.txt', iter(['ab', 'cd']), 0, 'utf-16'), ('cp.txt', iter([A_UNICODE])), encoding='cp1140')
+    assert open(fs.resolve('file.txt'), 'rb').read() == 'abcd'.encode('utf-16')
+    assert open(fs.resolve('cp.txt'), 'rb').read() == AS_CP1140
+
+def test_mk_rejects_unstreamable_contents(fs):
+    with pytest.raises(TypeError):
+        fs.mk(('file.txt', 42))
+
+def test_mt_streams_contents():
+    mt = MemoryTree(('file.txt', iter(['a', b'b'])))
+    assert mt.read('file.txt') == b'ab'
+
+
+# raw contents
+
+def test_mk_copies_a_source(fs):
+    fs.mk(('big.bin', b'\x00\xff' * 100000, 0))
+    fs.mk(('copy/big.bin', Source(fs.resolve('big.bin'))))
+    assert open(fs.resolve('copy/big.bin'), 'rb').read() == b'\x00\xff' * 100000
+
+def test_mk_copies_a_source_without_kernel_help(fs, monkeypatch):
+    monkeypatch.setattr(filesystem_tree, '_kernel_copies', lambda: iter([]))
+    fs.mk(('src.txt', '    Greetings, program!', 0), ('dst.txt', Source(fs.resolve('src.txt'))))
+    assert open(fs.resolve('dst.txt')).read() == '    Greetings, program!'
+
+def test_mk_falls_back_when_the_kernel_refuses(fs, monkeypatch):
+    def refuse(infd, outfd, offset, count):
+        raise OSError(errno.EXDEV, 'nope')
+    monkeypatch.setattr(filesystem_tree, '_kernel_copies', lambda: iter([refuse]))
+    fs.mk(('src.txt', 'hi'), ('dst.txt', Source(fs.resolve('src.txt'))))
+    assert open(fs.resolve('dst.txt')).read() == 'hi'
+
+def test_mk_writes_buffers_as_they_are(fs):
+    import mmap
+    fs.mk(('ba.bin', bytearray(b'  ba')), ('mv.bin', memoryview(b'  mv')))
+    fs.mk(('mm.bin', mmap.mmap(-1, 4)))
+    assert open(fs.resolve('ba.bin'), 'rb').read() == b'  ba'
+    assert open(fs.resolve('mv.bin'), 'rb').read() == b'  mv'
+    assert open(fs.resolve('mm.bin'), 'rb').read() == b'\x00' * 4
+
+def test_mt_copies_a_source(fs):
+    fs.mk(('src.txt', 'hi'))
+    assert MemoryTree(('dst.txt', Source(fs.resolve('src.txt')))).read('dst.txt') == b'hi'
+
+
+# sized contents
+
+GB = 1024 ** 3
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='no sparse files by default on Windows')
+def test_sized_makes_a_big_sparse_file(fs):
+    fs.mk(('big.bin', Sized(10 * GB)))
+    st = os.stat(fs.resolve('big.bin'))
+    assert st.st_size == 10 * GB
+    assert st.st_blocks * 512 < GB
+
+def test_sized_can_allocate(fs):
+    fs.mk(('file.bin', Sized(4096, allocate=True)))
+    assert open(fs.resolve('file.bin'), 'rb').read() == b'\0' * 4096
+
+def test_sized_repeats_a_pattern(fs):
+    fs.chunk_size = 8
+    fs.mk(('file.txt', Sized(10, pattern='abc')))
+    assert open(fs.resolve('file.txt')).read() == 'abcabcabca'
+
+def test_sized_encodes_a_text_pattern(fs):
+    fs.mk(('file.txt', Sized(2, pattern=A_UNICODE), 0, 'cp1140'))
+    assert open(fs.resolve('file.txt'), 'rb').read() == AS_CP1140 * 2
+
+def test_sized_with_a_seed_is_reproducible_across_chunk_sizes(fs):
+    fs.mk(('a.bin', Sized(100003, seed=42)))
+    fs.chunk_size = 1000
+    fs.mk(('b.bin', Sized(100003, seed=42)), ('c.bin', Sized(100003, seed=43)))
+    a, b, c = [open(fs.resolve(name), 'rb').read() for name in ('a.bin', 'b.bin', 'c.bin')]
+    assert len(a) == 100003
+    assert a == b
+    assert a != c
+
+def test_sized_rejects_bad_arguments():
+    with pytest.raises(ValueError):
+        Sized(-1)
+    with pytest.raises(ValueError):
+        Sized(10, pattern='a', seed=1)
+    with pytest.raises(ValueError):
+        Sized(10, pattern='')
+
+def test_mt_fills_in_sized_contents():
+    assert MemoryTree(('file.bin', Sized(3))).read('file.bin') == b'\0\0\0'
+
+
+# removal
+
+def test_remove_removes_nested_trees(fs):
+    fs.mk('a/b/c/d', ('a/file.txt', 'hi'), ('a/b/c/file.txt', 'hi'), 'e')
+    fs.remove()
+    assert not os.path.exists(fs.root)
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='symlinks need privileges on Windows')
+def test_remove_doesnt_follow_symlinks(fs):
+    outside = FilesystemTree(('keep/file.txt', 'hi'))
+    try:
+        fs.mk('dir')
+        os.symlink(outside.resolve('keep'), fs.resolve('dir/link'))
+        os.symlink(outside.resolve('keep/file.txt'), fs.resolve('link.txt'))
+        fs.remove()
+        assert not os.path.exists(fs.root)
+        assert open(outside.resolve('keep/file.txt')).read() == 'hi'
+    finally:
+        outside.remove()
+
+def test_remove_with_workers(fs):
+    fs.remove_workers = 4
+    fs.mk(*[('dir%d/sub/file%d.txt' % (i, j), 'hi') for i in range(8) for j in range(5)])
+    fs.remove()
+    assert not os.path.exists(fs.root)
+
+def test_remove_falls_back_to_shutil(fs, monkeypatch):
+    monkeypatch.setattr(filesystem_tree, '_fd_rmtree_supported', False)
+    fs.mk(('a/b/file.txt', 'hi'))
+    fs.remove()
+    assert not os.path.exists(fs.root)
+
+
+# background removal - br
+
+def test_br_returns_at_once_with_the_root_gone(fs):
+    fs.mk(*[('dir/file%d.txt' % i, 'hi') for i in range(100)])
+    removal = fs.remove(background=True)
+    assert not os.path.exists(fs.root)
+    assert removal.wait(10)
+    assert removal.done()
+    assert not os.path.exists(removal.path)
+
+def test_br_uses_a_graveyard_beside_the_root(fs):
+    removal = fs.remove(background=True)
+    graveyard = os.path.dirname(removal.path)
+    assert os.path.basename(graveyard) == filesystem_tree.GRAVEYARD_PREFIX + str(os.getpid())
+    assert os.path.dirname(graveyard) == os.path.dirname(fs.root)
+    removal.wait()
+
+def test_br_via_class_attribute_and_context_manager(monkeypatch):
+    monkeypatch.setattr(FilesystemTree, 'remove_in_background', True)
+    with FilesystemTree(('file.txt', 'hi')) as ft:
+        pass
+    assert not os.path.exists(ft.root)
+
+def test_br_falls_back_to_foreground_when_rename_fails(fs, monkeypatch):
+    def rename(src, dst):
+        raise OSError(errno.EXDEV, 'nope')
+    monkeypatch.setattr(os, 'rename', rename)
+    assert fs.remove(background=True) is None
+    assert not os.path.exists(fs.root)
+
+def test_br_of_a_missing_tree_does_nothing(fs):
+    fs.remove()
+    assert fs.remove(background=True) is None
+
+@pytest.mark.skipif(os.name != 'posix', reason='sweeping checks pids with os.kill')
+def test_br_sweeps_graveyards_of_dead_processes():
+    parent = FilesystemTree()
+    try:
+        dead = parent.resolve(filesystem_tree.GRAVEYARD_PREFIX + '999999999')
+        parent.mk(filesystem_tree.GRAVEYARD_PREFIX + '999999999/old/file.txt')
+        child = FilesystemTree(root=parent.resolve('child'))
+        child.mk('stuff')
+        child.remove(background=True).wait()  # the reaper works first-in, first-out
+        assert not os.path.exists(dead)
+    finally:
+        parent.remove()
+
+
+# pool
+
+@pytest.yield_fixture
+def pool():
+    pool = FilesystemTreePool(size=2)
+    yield pool
+    pool.close()
+
+def wait_for(predicate):
+    import time
+    for i in range(500):
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_pool_hands_out_trees(pool):
+    ft = pool.acquire(('file.txt', '    hi'))
+    assert isinstance(ft, FilesystemTree)
+    assert open(ft.resolve('file.txt')).read() == 'hi'
+
+def test_pool_is_callable_like_the_class(pool):
+    ft = pool(('file.txt', '    hi'), should_dedent=False)
+    assert open(ft.resolve('file.txt')).read() == '    hi'
+
+def test_pool_recycles_removed_roots_empty(pool):
+    ft = pool.acquire(('file.txt', 'hi'), 'dir')
+    root = ft.root
+    ft.remove()
+    assert wait_for(lambda: root in pool._idle)
+    assert os.listdir(root) == []
+
+def test_pool_release_twice_is_harmless():
+    with FilesystemTreePool(size=0, max_roots=1) as pool:
+        ft = pool.acquire(('a.txt', 'a'))
+        ft.remove()
+        other = pool.acquire(('b.txt', 'b'))
+        assert other.root == ft.root
+        ft.remove()
+        pool.close()  # let the worker finish anything queued
+        assert os.listdir(other.root) == ['b.txt']
+        other.remove()
+
+def test_pool_fills_with_template():
+    template = FilesystemTree(('file.txt', 'template'))
+    with FilesystemTreePool(size=1, template=template) as pool:
+        ft = pool.acquire()
+        assert open(ft.resolve('file.txt')).read() == 'template'
+        ft.mk(('file.txt', 'changed'), ('other.txt', 'hi'))
+        root = ft.root
+        ft.remove()
+        assert wait_for(lambda: root in pool._idle)
+        assert os.listdir(root) == ['file.txt']
+        assert open(os.path.join(root, 'file.txt')).read() == 'template'
+    template.remove()
+
+def test_pool_caps_roots_on_disk():
+    import threading
+    with FilesystemTreePool(size=4, max_roots=2) as pool:
+        a, b = pool.acquire(), pool.acquire()
+        got = []
+        thread = threading.Thread(target=lambda: got.append(pool.acquire()))
+        thread.start()
+        thread.join(0.2)
+        assert got == []
+        a.remove()
+        thread.join(5)
+        assert len(got) == 1
+        assert pool._count <= 2
+
+def test_pool_gets_the_root_back_when_the_treedef_is_bad():
+    import threading
+    with FilesystemTreePool(size=0, max_roots=1) as pool:
+        with pytest.raises(TypeError):
+            pool.acquire(42)
+        got = []
+        thread = threading.Thread(target=lambda: got.append(pool.acquire(('a.txt', 'a'))))
+        thread.start()
+        thread.join(5)
+        assert len(got) == 1
+        assert os.listdir(got[0].root) == ['a.txt']
+        got[0].remove()
+
+def test_pool_is_thread_safe(pool):
+    import threading
+    roots = []
+    def work():
+        for i in range(10):
+            ft = pool.acquire(('file.txt', 'hi'))
+            roots.append(ft.root)
+            ft.remove()
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(roots) == 40
+
+def test_pool_close_removes_roots():
+    pool = FilesystemTreePool(size=2)
+    ft = pool.acquire()
+    assert wait_for(lambda: len(pool._idle) == 2)
+    idle = list(pool._idle)
+    pool.close()
+    assert not any(os.path.exists(root) for root in idle)
+    ft.remove()
+    assert not os.path.exists(ft.root)
+    with pytest.raises(ValueError):
+        pool.acquire()
+
+
+# reset
+
+def count_writes(fs, monkeypatch):
+    written = []
+    write_file = fs._write_file
+    def _write_file(path, *a, **kw):
+        written.append(path)
+        return write_file(path, *a, **kw)
+    monkeypatch.setattr(fs, '_write_file', _write_file)
+    return written
+
+def test_reset_starts_from_scratch(fs):
+    fs.mk(('old.txt', 'old'), 'old/dir')
+    fs.reset(('new.txt', 'new'))
+    assert os.listdir(fs.root) == ['new.txt']
+
+def test_reset_leaves_what_it_did_not_make_alone(tmpdir):
+    tmpdir.mkdir('precious').join('data.txt').write('keep me')
+    fs = FilesystemTree(root=str(tmpdir))
+    fs.reset(('a.txt', 'a'))
+    assert sorted(os.listdir(str(tmpdir))) == ['a.txt', 'precious']
+    assert tmpdir.join('precious', 'data.txt').read() == 'keep me'
+
+def test_reset_only_writes_what_changed(fs, monkeypatch):
+    fs.reset(('same.txt', 'same'), ('changed.txt', 'before'), ('dir/gone.txt', 'gone'), 'empty')
+    written = count_writes(fs, monkeypatch)
+    fs.reset(('same.txt', 'same'), ('changed.txt', 'after'), ('new/new.txt', 'new'))
+    assert written == ['changed.txt', os.path.join('new', 'new.txt')]
+    assert sorted(os.listdir(fs.root)) == ['changed.txt', 'new', 'same.txt']
+    assert open(fs.resolve('changed.txt')).read() == 'after'
+
+def test_reset_notices_changes_on_disk(fs, monkeypatch):
+    fs.reset(('file.txt', 'original'))
+    with open(fs.resolve('file.txt'), 'w') as f:
+        f.write('tampered with')
+    written = count_writes(fs, monkeypatch)
+    fs.reset(('file.txt', 'original'))
+    assert written == ['file.txt']
+    assert open(fs.resolve('file.txt')).read() == 'original'
+
+def test_reset_rewrites_deleted_files(fs):
+    fs.reset(('file.txt', 'hi'))
+    os.remove(fs.resolve('file.txt'))
+    fs.reset(('file.txt', 'hi'))
+    assert open(fs.resolve('file.txt')).read() == 'hi'
+
+def test_reset_leaves_directories_that_arent_empty(fs):
+    fs.reset(('dir/file.txt', 'hi'))
+    with open(fs.resolve('dir/other.txt'), 'w') as f:
+        f.write('made by the code under test')
+    fs.reset()
+    assert os.listdir(fs.resolve('dir')) == ['other.txt']
+
+def test_reset_always_rewrites_streams(fs, monkeypatch):
+    fs.reset(('file.txt', iter(['hi'])))
+    written = count_writes(fs, monkeypatch)
+    fs.reset(('file.txt', iter(['hi'])))
+    assert written == ['file.txt']
+
+def test_reset_after_remove_starts_from_scratch(fs, monkeypatch):
+    fs.reset(('file.txt', 'hi'))
+    fs.remove()
+    fs.reset(('file.txt', 'hi'))
+    assert open(fs.resolve('file.txt')).read() == 'hi'
+
+
+# dedup
+
+def test_dedup_hardlinks_identical_files(fs):
+    fs.mk(('a/__init__.py', ''), ('b/__init__.py', ''), ('c.txt', 'different'), dedup=True)
+    a, b = os.stat(fs.resolve('a/__init__.py')), os.stat(fs.resolve('b/__init__.py'))
+    assert a.st_ino == b.st_ino
+    assert os.stat(fs.resolve('c.txt')).st_ino != a.st_ino
+    assert len(os.listdir(fs.resolve(FilesystemTree.blob_dir))) == 2
+
+def test_dedup_respects_dedent_and_encoding(fs):
+    fs.mk(('a.txt', '    hi'), ('b.txt', 'hi'), ('c.txt', A_UNICODE, 0, 'cp1140'), dedup='hardlink')
+    assert os.stat(fs.resolve('a.txt')).st_ino == os.stat(fs.resolve('b.txt')).st_ino
+    assert open(fs.resolve('a.txt')).read() == 'hi'
+    assert open(fs.resolve('c.txt'), 'rb').read() == AS_CP1140
+
+def test_dedup_reuses_the_store_across_calls(fs):
+    fs.mk(('a.txt', 'hi'), dedup=True)
+    fs.mk(('b.txt', 'hi'), dedup=True)
+    assert os.stat(fs.resolve('a.txt')).st_ino == os.stat(fs.resolve('b.txt')).st_ino
+
+def test_dedup_rewriting_a_file_doesnt_touch_its_twins(fs):
+    fs.mk(('a.txt', 'hi'), ('b.txt', 'hi'), dedup=True)
+    fs.mk(('a.txt', 'changed'))
+    assert open(fs.resolve('a.txt')).read() == 'changed'
+    assert open(fs.resolve('b.txt')).read() == 'hi'
+
+def test_dedup_rewrites_a_blob_changed_through_a_link(fs):
+    fs.mk(('a.txt', 'hi'), dedup=True)
+    with open(fs.resolve('a.txt'), 'w') as f:
+        f.write('changed in place')
+    fs.mk(('b.txt', 'hi'), dedup=True)
+    assert open(fs.resolve('b.txt')).read() == 'hi'
+    assert open(fs.resolve('a.txt')).read() == 'changed in place'
+
+def test_dedup_checks_blobs_another_tree_wrote(fs):
+    fs.mk(('a.txt', 'hi'), dedup=True)
+    with open(fs.resolve('a.txt'), 'w') as f:
+        f.write('ho')
+    other = FilesystemTree(root=fs.root)
+    other.mk(('b.txt', 'hi'), dedup=True)
+    assert open(fs.resolve('b.txt')).read() == 'hi'
+
+def test_dedup_reflink_gives_files_their_own_contents(fs):
+    fs.mk(('a.txt', 'hi'), ('b.txt', 'hi'), dedup='reflink')
+    with open(fs.resolve('a.txt'), 'w') as f:
+        f.write('changed in place')
+    assert open(fs.resolve('b.txt')).read() == 'hi'
+
+def test_dedup_via_constructor_writes_streams_normally():
+    fs = FilesystemTree(('a.txt', iter(['hi'])), ('b.txt', 'hi'), dedup=True)
+    try:
+        assert open(fs.resolve('a.txt')).read() == 'hi'
+        assert os.stat(fs.resolve('a.txt')).st_ino != os.stat(fs.resolve('b.txt')).st_ino
+    finally:
+        fs.remove()
+
+def test_dedup_rejects_unknown_modes(fs):
+    with pytest.raises(ValueError):
+        fs.mk(('a.txt', 'hi'), dedup='symlink')
+
+
+# compiled treedefs - ct
+
+def test_ct_compiles_to_a_plan():
+    plan = compile_treedef('empty', ('/some/dir/file.txt', '    hi'), ('raw.txt', '    hi', 0))
+    assert isinstance(plan, Plan)
+    assert plan.dirs == ('some/dir', 'some', 'empty', '')
+    assert plan.files == ( ('some/dir/file.txt', b'hi', False, 'UTF-8')
+                         , ('raw.txt', b'    hi', False, 'UTF-8')
+                          )
+    assert plan.size == 8
+
+def test_ct_plans_are_immutable():
+    plan = compile_treedef(('file.txt', 'hi'))
+    with pytest.raises(AttributeError):
+        plan.size = 0
+
+def test_ct_takes_should_dedent_and_encoding():
+    plan = compile_treedef(('file.txt', '    ' + A_UNICODE), should_dedent=False, encoding='cp1140')
+    assert plan.files[0][1] == b'@@@@' + AS_CP1140
+
+def test_ct_raises_like_mk():
+    with pytest.raises(ValueError):
+        compile_treedef(('file.txt',))
+    with pytest.raises(TypeError):
+        compile_treedef(42)
+
+def test_ct_plans_replay_in_mk(fs):
+    plan = compile_treedef('empty', ('some/dir/file.txt', '    hi'))
+    fs.mk(plan)
+    assert isdir(fs.resolve('empty'))
+    assert open(fs.resolve('some/dir/file.txt')).read() == 'hi'
+
+def test_ct_plans_replay_in_the_constructor_and_mix_with_other_items():
+    plan = compile_treedef(('file.txt', 'hi'))
+    fs = FilesystemTree(plan, ('other.txt', 'there'), workers=2)
+    try:
+        assert open(fs.resolve('file.txt')).read() == 'hi'
+        assert open(fs.resolve('other.txt')).read() == 'there'
+    finally:
+        fs.remove()
+
+def test_ct_plans_replay_in_a_memory_tree():
+    plan = compile_treedef(('some/file.txt', 'hi'))
+    assert MemoryTree(plan).read('some/file.txt') == b'hi'
+
+def test_ct_plans_work_with_dedup(fs):
+    fs.mk(compile_treedef(('a.txt', 'hi'), ('b.txt', 'hi')), dedup=True)
+    assert os.stat(fs.resolve('a.txt')).st_ino == os.stat(fs.resolve('b.txt')).st_ino
+
+
+# content cache - cc
+
+def test_cc_hits_on_repeated_contents(fs, monkeypatch):
+    cache = ContentCache()
+    monkeypatch.setattr(fs, 'content_cache', cache)
+    fs.mk(('a.txt', '    hi'), ('b.txt', '    hi'), ('c.txt', '    hi', 0))
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 2, 'bytes': 20}
+    assert open(fs.resolve('b.txt')).read() == 'hi'
+    assert open(fs.resolve('c.txt')).read() == '    hi'
+
+def test_cc_keys_on_encoding():
+    cache = ContentCache()
+    assert cache.encode(A_UNICODE, True, 'utf8') == AS_UTF8
+    assert cache.encode(A_UNICODE, True, 'cp1140') == AS_CP1140
+    assert cache.stats()['misses'] == 2
+
+def test_cc_evicts_least_recently_used():
+    cache = ContentCache(maxsize=2)
+    cache.encode('a', True, 'utf8')
+    cache.encode('b', True, 'utf8')
+    cache.encode('a', True, 'utf8')
+    cache.encode('c', True, 'utf8')
+    assert [key[1] for key in cache._entries] == ['a', 'c']
+
+def test_cc_stays_within_max_bytes():
+    cache = ContentCache(max_bytes=100)
+    for i in range(100):
+        cache.encode('unique contents %d' % i, True, 'utf8')
+    assert cache.stats()['bytes'] <= 100
+
+def test_cc_skips_big_contents():
+    cache = ContentCache(max_item_bytes=10)
+    assert cache.encode('x' * 11, True, 'utf8') == b'x' * 11
+    assert cache.stats()['size'] == 0
+
+def test_cc_can_be_turned_off(fs, monkeypatch):
+    monkeypatch.setattr(fs, 'content_cache', None)
+    fs.mk(('a.txt', '    hi'))
+    assert open(fs.resolve('a.txt')).read() == 'hi'
+
+def test_cc_clear():
+    cache = ContentCache()
+    cache.encode('a', True, 'utf8')
+    cache.clear()
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'size': 0, 'bytes': 0}
+
+
+# clone
+
+def test_clone_copies_files_and_dirs(fs):
+    fs.mk('empty/dir', ('some/dir/file.txt', 'Greetings, program!'))
+    clone = fs.clone()
+    try:
+        assert clone.root != fs.root
+        assert isdir(clone.resolve('empty/dir'))
+        assert open(clone.resolve('some/dir/file.txt')).read() == 'Greetings, program!'
+    finally:
+        clone.remove()
+
+def test_clone_is_independent_of_template(fs):
+    fs.mk(('file.txt', 'template'))
+    clone = fs.clone(link='copy')
+    try:
+        clone.mk(('file.txt', 'changed'))
+        assert open(fs.resolve('file.txt')).read() == 'template'
+    finally:
+        clone.remove()
+
+def test_clone_can_hardlink(fs):
+    fs.mk(('file.txt', 'shared'))
+    clone = fs.clone(link='hardlink')
+    try:
+        assert os.stat(clone.resolve('file.txt')).st_ino == os.stat(fs.resolve('file.txt')).st_ino
+    finally:
+        clone.remove()
+
+def test_clone_mk_does_not_write_through_hardlinks(fs):
+    fs.mk(('f.txt', 'original'), ('dir/g.txt', 'original'))
+    clone = fs.clone(link='hardlink')
+    clone.mk(('f.txt', 'changed'), ('dir/g.txt', 'changed'))
+    assert open(fs.resolve('f.txt')).read() == 'original'
+    assert open(fs.resolve('dir/g.txt')).read() == 'original'
+    assert open(clone.resolve('f.txt')).read() == 'changed'
+    clone.remove()
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='symlinks need privileges on Windows')
+def test_clone_keeps_symlinks(fs):
+    fs.mk(('file.txt', 'target'))
+    os.symlink('file.txt', fs.resolve('link.txt'))
+    clone = fs.clone()
+    try:
+        assert os.readlink(os.path.join(clone.root, 'link.txt')) == 'file.txt'
+    finally:
+        clone.remove()
+
+def test_clone_rejects_unknown_link(fs):
+    with pytest.raises(ValueError):
+        fs.clone(link='teleport')
+
+
+# observer and stats - os
+
+def test_os_stats_counts_what_mk_does(fs):
+    fs.mk(('a/b/c.txt', 'hello'), ('a/d.txt', b'hi', False), 'e')
+    stats = fs.stats()
+    assert stats['dirs_created'] == 3
+    assert stats['files_written'] == 2
+    assert stats['bytes_written'] == 7
+    assert stats['syscalls'] >= 9
+    assert stats['removals'] == 0
+
+def test_os_stats_counts_removals():
+    fs = FilesystemTree(('a.txt', 'a'))
+    fs.remove()
+    assert fs.stats()['removals'] == 1
+
+def test_os_stats_counts_streamed_and_sized_bytes(fs):
+    fs.mk(('a.txt', iter(['he', 'llo'])), ('b.bin', filesystem_tree.Sized(10)))
+    assert fs.stats()['bytes_written'] == 15
+
+def test_os_observer_sees_each_step(monkeypatch):
+    monkeypatch.setattr(FilesystemTree, 'content_cache', None)
+    events = []
+    fs = FilesystemTree(observer=events.append)
+    fs.mk(('a/b.txt', '  hello'))
+    fs.remove()
+    assert [(e.op, e.path, e.bytes) for e in events] == [ ('mkdir', 'a', None)
+                                                       , ('dedent', os.path.join('a', 'b.txt'), None)
+                                                       , ('encode', os.path.join('a', 'b.txt'), 5)
+                                                       , ('write', os.path.join('a', 'b.txt'), 5)
+                                                       , ('remove', '', None)
+                                                        ]
+    assert all(isinstance(e, Event) and e.duration >= 0 for e in events)
+
+def test_os_observer_skips_contents_from_the_cache():
+    events = []
+    fs = FilesystemTree()
+    fs.content_cache = ContentCache()
+    fs.mk(('a.txt', 'cached for the observer'))
+    fs.observer = events.append
+    fs.mk(('a.txt', 'cached for the observer'))
+    assert [e.op for e in events] == ['write']
+    fs.remove()
+
+def test_os_observer_sees_links(fs):
+    events = []
+    fs.observer = events.append
+    fs.mk(('a.txt', 'same', False), ('b.txt', 'same', False), dedup='hardlink')
+    assert sorted(e.path for e in events if e.op == 'link') == ['a.txt', 'b.txt']
+
+def test_os_nothing_is_timed_without_an_observer(fs, monkeypatch):
+    def clock():
+        raise AssertionError('timed without an observer')
+    monkeypatch.setattr(filesystem_tree, '_clock', clock)
+    fs.mk(('a/b.txt', 'hello'), ('c.txt', 'goodbye'), 'd')
+    fs.remove()
+
+def test_os_clones_keep_the_observer(fs):
+    fs.observer = lambda event: None
+    clone = fs.clone()
+    assert clone.observer is fs.observer
+    clone.remove()
+
+
+# snapshot - ss
+
+def test_ss_yields_a_treedef(fs):
+    fs.mk(('a/b.txt', 'b'), ('a/c/d.txt', 'd'), 'e', ('f.txt', 'f'))
+    items = list(fs.snapshot())
+    assert [item[0] if isinstance(item, tuple) else item for item in items] == \
+                                         ['a', 'e', 'f.txt', 'a/b.txt', 'a/c', 'a/c/d.txt']
+    assert all(isinstance(item[1], LazyFile) for item in items if isinstance(item, tuple))
+
+def test_ss_reads_lazily(fs):
+    fs.mk(('a.txt', 'before'))
+    (path, contents), = fs.snapshot()
+    with open(fs.resolve('a.txt'), 'w') as f:
+        f.write('after')
+    assert contents.read() == b'after'
+    assert contents.read() == b''
+
+def test_ss_reads_in_chunks(fs):
+    fs.mk(('a.txt', 'hello'))
+    (path, contents), = fs.snapshot()
+    assert [contents.read(2), contents.read(2), contents.read(2), contents.read(2)] == [b'he', b'll', b'o', b'']
+
+def test_ss_read_zero_is_not_the_end(fs):
+    fs.mk(('a.txt', 'abc'))
+    (path, contents), = fs.snapshot()
+    assert contents.read(0) == b''
+    assert contents.read() == b'abc'
+
+def test_ss_round_trips_through_mk(fs):
+    fs.mk(('a/b.txt', '  indented'), ('c.bin', b'\x00\xff', False), 'empty/dir')
+    copy = FilesystemTree(*fs.snapshot())
+    try:
+        assert open(copy.resolve('a/b.txt')).read() == 'indented'
+        assert open(copy.resolve('c.bin'), 'rb').read() == b'\x00\xff'
+        assert isdir(copy.resolve('empty/dir'))
+    finally:
+        copy.remove()
+
+def test_ss_includes_and_excludes(fs):
+    fs.mk(('a/b.py', ''), ('a/c.txt', ''), ('build/d.py', ''), ('e.py', ''))
+    paths = lambda **kw: [item[0] for item in fs.snapshot(**kw) if isinstance(item, tuple)]
+    assert paths(include='*.py') == ['e.py', 'a/b.py', 'build/d.py']
+    assert paths(include='*.py', exclude='build') == ['e.py', 'a/b.py']
+    assert paths(exclude=['*.py', 'build']) == ['a/c.txt']
+
+def test_ss_leaves_out_the_content_store(fs):
+    fs.mk(('a.txt', 'same'), ('b.txt', 'same'), dedup='hardlink')
+    assert [item[0] for item in fs.snapshot()] == ['a.txt', 'b.txt']
+
+
+# diff - df
+
+def test_df_finds_no_differences_in_what_mk_wrote(fs):
+    treedef = [('a/b.txt', '''
+        indented
+    '''), ('c.txt', 'caf\u00e9', True, 'latin-1'), 'd/e']
+    fs.mk(*treedef)
+    diff = fs.diff(*treedef)
+    assert diff == TreeDiff([], [], [])
+    assert not diff
+    fs.assert_matches(*treedef)
+
+def test_df_matches_directories_with_a_trailing_slash(fs):
+    treedef = [('a/b.txt', 'hello'), 'empty/', 'nested/dir/']
+    fs.mk(*treedef)
+    assert not fs.diff(*treedef)
+    fs.assert_matches(*treedef)
+
+def test_df_finds_added_removed_and_changed_paths(fs):
+    fs.mk(('a.txt', 'a'), ('b/c.txt', 'c'), ('same-size.txt', 'x'))
+    diff = fs.diff(('a.txt', 'A'), ('d/e.txt', 'e'), ('same-size.txt', 'y'))
+    assert diff.added == ['b', 'b/c.txt']
+    assert diff.removed == ['d', 'd/e.txt']
+    assert diff.changed == ['a.txt', 'same-size.txt']
+
+def test_df_only_hashes_same_size_files(fs, monkeypatch):
+    fs.mk(('a.txt', 'short'), ('b.txt', 'same'))
+    hashed = []
+    differs = FilesystemTree._differs
+    def spy(self, full, *a):
+        hashed.append(os.path.basename(full))
+        return differs(self, full, *a)
+    monkeypatch.setattr(FilesystemTree, '_differs', spy)
+    assert fs.diff(('a.txt', 'much longer'), ('b.txt', 'SAME')).changed == ['a.txt', 'b.txt']
+    assert hashed == ['b.txt']
+
+def test_df_compares_raw_and_streamed_contents(fs):
+    fs.mk(('a.bin', Sized(100000, seed=1)), ('b.txt', 'streamed'), ('c.bin', bytearray(b'raw'), False))
+    assert not fs.diff( ('a.bin', Sized(100000, seed=1))
+                      , ('b.txt', iter(['stream', 'ed']))
+                      , ('c.bin', memoryview(b'raw'))
+                       )
+    assert fs.diff(('a.bin', Sized(100000, seed=2)), ('b.txt', iter(['x'])), ('c.bin', b'raw', False)).changed == \
+                                                                                          ['a.bin', 'b.txt']
+
+def test_df_hashes_with_workers(fs):
+    treedef = [('f%d.txt' % i, 'file %d' % i) for i in range(20)]
+    fs.mk(*treedef)
+    assert not fs.diff(*treedef, workers=4)
+    treedef[7] = ('f7.txt', 'file X')
+    assert fs.diff(*treedef, workers=4).changed == ['f7.txt']
+
+def test_df_a_file_where_a_dir_is_expected_is_added_and_removed(fs):
+    fs.mk(('a', 'a file'))
+    diff = fs.diff('a')
+    assert (diff.added, diff.removed) == (['a'], ['a'])
+
+def test_df_a_dir_where_a_file_is_expected_is_added_and_removed(fs):
+    fs.mk('a')
+    diff = fs.diff(('a', 'a file'))
+    assert (diff.added, diff.removed) == (['a'], ['a'])
+
+@pytest.mark.skipif(not hasattr(os, 'scandir'), reason='no scandir')
+def test_df_takes_sizes_from_the_listing(fs, monkeypatch):
+    fs.mk(('a.txt', 'short'), ('b/c.txt', 'c'))
+    stats = []
+    real_stat = os.stat
+    def spy(path, *a, **kw):
+        stats.append(path)
+        return real_stat(path, *a, **kw)
+    monkeypatch.setattr(os, 'stat', spy)
+    assert fs.diff(('a.txt', 'much longer'), ('b/c.txt', 'c')).changed == ['a.txt']
+    assert stats == []
+
+def test_df_assert_matches_raises_with_the_diff(fs):
+    fs.mk(('a.txt', 'a'))
+    with pytest.raises(AssertionError) as info:
+        fs.assert_matches(('b.txt', 'b'))
+    assert '+ a.txt' in str(info.value)
+    assert '- b.txt' in str(info.value)
+
+
+# archives - ar
+
+def tarball(*members, **kw):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:' + kw.get('compression', '')) as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    return buf
+
+class Unseekable(io.RawIOBase):
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+    def readable(self):
+        return True
+    def readinto(self, b):
+        data = self.data.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def test_ar_extracts_a_tarball(fs):
+    fs.mk_from_archive(tarball(('a/b.txt', b'  b'), ('c', None), ('d.txt', b'')))
+    assert open(fs.resolve('a/b.txt')).read() == '  b'
+    assert isdir(fs.resolve('c'))
+    assert fs.stats()['files_written'] == 2
+
+def test_ar_extracts_a_compressed_tarball_from_a_stream(fs):
+    fs.mk_from_archive(Unseekable(tarball(('a.txt', b'a'), compression='gz').getvalue()))
+    assert open(fs.resolve('a.txt')).read() == 'a'
+
+def test_ar_extracts_a_zip_file(fs):
+    path = os.path.join(fs.root, 'archive.zip')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('dir/', b'')
+        archive.writestr('sub/file.txt', b'zipped')
+    fs.mk_from_archive(path)
+    assert isdir(fs.resolve('dir'))
+    assert open(fs.resolve('sub/file.txt')).read() == 'zipped'
+
+def test_ar_confines_members_to_the_root(fs):
+    fs.mk_from_archive(tarball(('/etc/passwd', b'not really'), ('./a/./b.txt', b'b')))
+    assert open(fs.resolve('etc/passwd')).read() == 'not really'
+    assert open(fs.resolve('a/b.txt')).read() == 'b'
+    with pytest.raises(ValueError):
+        fs.mk_from_archive(tarball(('a/../../escaped.txt', b'')))
+    assert not os.path.exists(os.path.join(os.path.dirname(fs.root), 'escaped.txt'))
+
+def test_ar_skips_symlinks(fs):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        info = tarfile.TarInfo('link')
+        info.type = tarfile.SYMTYPE
+        info.linkname = '/etc/passwd'
+        tar.addfile(info)
+    buf.seek(0)
+    fs.mk_from_archive(buf)
+    assert os.listdir(fs.root) == []
+
+@pytest.mark.parametrize('format', ['tar', 'gztar', 'bztar', 'zip'])
+def test_ar_export_round_trips(fs, format):
+    treedef = [('a/b.txt', 'b'), ('c.bin', b'\x00\xff', False), 'empty']
+    fs.mk(*treedef)
+    path = os.path.join(tempfile.mkdtemp(), 'archive')
+    try:
+        fs.export_archive(path, format)
+        copy = FilesystemTree()
+        copy.mk_from_archive(path)
+        assert not copy.diff(*treedef)
+        copy.remove()
+    finally:
+        FilesystemTree(root=os.path.dirname(path)).remove()
+
+def test_ar_export_round_trips_hardlinks(fs):
+    treedef = [('a/__init__.py', ''), ('b/__init__.py', ''), ('c.txt', 'c'), ('d.txt', 'c')]
+    fs.mk(*treedef, dedup=True)
+    buf = io.BytesIO()
+    fs.export_archive(buf)
+    with tarfile.open(fileobj=io.BytesIO(buf.getvalue())) as tar:
+        assert any(info.islnk() for info in tar)
+    copy = FilesystemTree()
+    try:
+        copy.mk_from_archive(io.BytesIO(buf.getvalue()))
+        assert not copy.diff(*treedef)
+    finally:
+        copy.remove()
+
+def test_ar_refuses_hardlinks_to_missing_members(fs):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        info = tarfile.TarInfo('link')
+        info.type = tarfile.LNKTYPE
+        info.linkname = 'missing.txt'
+        tar.addfile(info)
+    buf.seek(0)
+    with pytest.raises(ValueError):
+        fs.mk_from_archive(buf)
+
+def test_ar_export_streams_to_a_file_object(fs):
+    fs.mk(('a.txt', 'a'), ('b.log', 'b'))
+    buf = io.BytesIO()
+    fs.export_archive(buf, exclude='*.log')
+    with tarfile.open(fileobj=io.BytesIO(buf.getvalue())) as tar:
+        assert tar.getnames() == ['a.txt']
+
+def test_ar_export_rejects_unknown_formats(fs):
+    with pytest.raises(ValueError):
+        fs.export_archive(io.BytesIO(), 'rar')
+
+
+# directory descriptors - dd
+
+needs_dir_fds = pytest.mark.skipif(not filesystem_tree._dir_fds_supported, reason='no dir_fd support')
+
+@needs_dir_fds
+def test_dd_mk_keeps_writing_into_a_renamed_root(fs):
+    fs.mk(('a/b.txt', 'b'))
+    moved = fs.root + '-moved'
+    def rename(event):
+        if event.path == 'a/c.txt':
+            os.rename(fs.root, moved)
+    fs.observer = rename
+    try:
+        fs.mk(('a/c.txt', 'c'), ('d/e.txt', 'e'))
+        assert sorted(os.listdir(os.path.join(moved, 'a'))) == ['b.txt', 'c.txt']
+        assert os.listdir(os.path.join(moved, 'd')) == ['e.txt']
+        assert not os.path.exists(fs.root)
+    finally:
+        os.rename(moved, fs.root)
+
+@needs_dir_fds
+def test_dd_keeps_at_most_dir_fds_subdirectories_open(fs, monkeypatch):
+    monkeypatch.setattr(FilesystemTree, 'dir_fds', 2)
+    open_fds = []
+    fs.observer = lambda event: open_fds.append(len(fs._subdir_fds))
+    fs.mk(*[('d%d/sub/f%d.txt' % (i % 5, i), str(i)) for i in range(20)])
+    assert max(open_fds) == 2
+    assert open(fs.resolve('d3/sub/f13.txt')).read() == '13'
+
+@needs_dir_fds
+def test_dd_recovers_when_a_cached_subdirectory_is_removed(fs, monkeypatch):
+    monkeypatch.setattr(FilesystemTree, 'dir_fds', 4)
+    fs.mk(('a/b.txt', 'b'))
+    FilesystemTree(root=fs.resolve('a')).remove()
+    fs.mk(('a/c.txt', 'c'))
+    assert os.listdir(fs.resolve('a')) == ['c.txt']
+
+@needs_dir_fds
+def test_dd_recovers_when_the_root_is_removed(fs):
+    fs.mk(('a/b.txt', 'b'))
+    FilesystemTree(root=fs.root).remove()
+    fs.mk(('a/c.txt', 'c'), ('d.txt', 'd'))
+    assert sorted(os.listdir(fs.root)) == ['a', 'd.txt']
+
+@needs_dir_fds
+def test_dd_are_closed_when_mk_returns(fs, monkeypatch):
+    monkeypatch.setattr(FilesystemTree, 'dir_fds', 4)
+    fds = []
+    fs.observer = lambda event: fds.extend([fs._root_fd] + list(fs._subdir_fds.values()))
+    fs.mk(('a/b.txt', 'b'))
+    assert len(set(fds)) == 2  # root and 'a'
+    for fd in set(fds):
+        with pytest.raises(OSError):
+            os.fstat(fd)
+
+@needs_dir_fds
+@pytest.mark.skipif(resource is None, reason='no resource module')
+def test_dd_more_trees_than_the_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    trees = []
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(128, hard), hard))
+    try:
+        for i in range(200):
+            trees.append(FilesystemTree(('a.txt', 'a')))
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        for tree in trees:
+            tree.remove()
+    assert len(trees) == 200
+
+@needs_dir_fds
+def test_dd_follow_root_changes(fs, tmpdir):
+    fs.mk(('a.txt', 'a'))
+    fs.root = str(tmpdir)
+    fs.mk(('b.txt', 'b'))
+    assert os.listdir(str(tmpdir)) == ['b.txt']
+
+
+# resolve - rs
+
+def test_rs_resolves_paths_mk_made_without_realpath(fs, monkeypatch):
+    fs.mk(('a/b/c.txt', 'c'), 'd')
+    fs.resolve()  # works out the real root, once
+    calls = []
+    monkeypatch.setattr(filesystem_tree, 'realpath', lambda path: calls.append(path) or os.path.realpath(path))
+    assert fs.resolve('a/b/c.txt') == os.path.realpath(os.path.join(fs.root, 'a', 'b', 'c.txt'))
+    assert fs.resolve('/a/b//') == os.path.realpath(os.path.join(fs.root, 'a', 'b'))
+    assert fs.resolve('d/not-yet.txt') == os.path.realpath(os.path.join(fs.root, 'd', 'not-yet.txt'))
+    assert fs.resolve() == os.path.realpath(fs.root)
+    assert calls == []
+
+def test_rs_follows_symlinks_mk_did_not_make(fs):
+    fs.mk(('real/file.txt', 'hi'), 'made')
+    os.symlink(fs.resolve('real'), os.path.join(fs.root, 'link'))
+    os.symlink(fs.resolve('real/file.txt'), os.path.join(fs.root, 'made', 'file.txt'))
+    fs.mk(('link/other.txt', 'there'))
+    assert fs.resolve('link/file.txt') == fs.resolve('real/file.txt')
+    assert fs.resolve('link/other.txt') == fs.resolve('real/other.txt')
+    assert fs.resolve('made/file.txt') == fs.resolve('real/file.txt')
+    assert fs.resolve('made/../real') == fs.resolve('real')
+
+def test_rs_uses_the_real_root(tmpdir):
+    os.symlink(str(tmpdir.mkdir('real')), str(tmpdir.join('link')))
+    fs = FilesystemTree(('a/b.txt', 'b'), root=str(tmpdir.join('link')))
+    assert fs.resolve('a/b.txt') == os.path.realpath(str(tmpdir.join('real', 'a', 'b.txt')))
+
+def test_rs_forgets_on_root_change(fs, tmpdir):
+    fs.mk(('a.txt', 'a'))
+    assert fs.resolve('a.txt').startswith(os.path.realpath(fs.root))
+    fs.root = str(tmpdir)
+    assert fs.resolve('a.txt') == os.path.realpath(str(tmpdir.join('a.txt')))
+
+def test_rs_memo_is_bounded(fs, monkeypatch):
+    monkeypatch.setattr(FilesystemTree, 'resolve_cache_size', 5)
+    fs.mk(*[('f%d.txt' % i, '') for i in range(20)])
+    fs.resolve_many('f%d.txt' % i for i in range(20))
+    assert len(fs._resolve_memo) == 5
+
+def test_rs_resolve_many(fs):
+    fs.mk(('a/b.txt', 'b'))
+    assert fs.resolve_many(['a', 'a/b.txt', '']) == [fs.resolve('a'), fs.resolve('a/b.txt'), fs.resolve()]
+
+
+# atomic mk - at
+
+def staging_dirs(fs):
+    parent = os.path.dirname(os.path.realpath(fs.root))
+    return [name for name in os.listdir(parent) if name.startswith('.filesystem-tree-staging-')]
+
+def test_at_builds_the_tree(fs):
+    fs.mk(('old.txt', 'old'), ('dir/kept.txt', 'kept'))
+    root_inode = os.stat(fs.root).st_ino
+    fs.mk(('new/file.txt', 'new'), ('old.txt', 'changed'), atomic=True)
+    assert os.stat(fs.root).st_ino != root_inode
+    assert open(fs.resolve('new/file.txt')).read() == 'new'
+    assert open(fs.resolve('old.txt')).read() == 'changed'
+    assert open(fs.resolve('dir/kept.txt')).read() == 'kept'
+    assert staging_dirs(fs) == []
+
+def test_at_leaves_the_tree_alone_on_failure(fs):
+    fs.mk(('old.txt', 'old'))
+    with pytest.raises(LookupError):
+        fs.mk(('a.txt', 'a'), ('b.txt', 'b', True, 'no-such-codec'), atomic=True)
+    assert os.listdir(fs.root) == ['old.txt']
+    assert staging_dirs(fs) == []
+
+def test_at_does_not_write_through_to_the_old_tree(fs):
+    fs.mk(('a.txt', 'before'))
+    before = open(fs.resolve('a.txt'))
+    fs.mk(('a.txt', 'after'), atomic=True)
+    assert before.read() == 'before'
+    before.close()
+    assert open(fs.resolve('a.txt')).read() == 'after'
+
+def test_at_works_without_renameat2(fs, monkeypatch):
+    monkeypatch.setattr(filesystem_tree, '_exchange', lambda a, b: False)
+    fs.mk(('old.txt', 'old'))
+    fs.mk(('new.txt', 'new'), atomic=True, fsync=True)
+    assert sorted(os.listdir(fs.root)) == ['new.txt', 'old.txt']
+    assert staging_dirs(fs) == []
+
+def test_at_makes_a_missing_root(tmpdir):
+    fs = FilesystemTree(root=str(tmpdir.join('missing')))
+    fs.mk(('a.txt', 'a'), atomic=True)
+    assert open(fs.resolve('a.txt')).read() == 'a'
+
+def test_at_uses_the_trees_settings(fs):
+    fs.blob_dir = 'myblobs'
+    fs.chunk_size = 4
+    fs.mk(('a.txt', 'same'), ('b.txt', 'same'), ('c.txt', iter(['streamed'])), dedup=True, atomic=True)
+    assert sorted(os.listdir(fs.root)) == ['a.txt', 'b.txt', 'c.txt', 'myblobs']
+    assert open(fs.resolve('c.txt')).read() == 'streamed'
+
+def test_at_keeps_the_trees_state_in_step(fs):
+    fs.reset(('a.txt', 'a'), ('b/c.txt', 'c'))
+    fs.mk(('d/e.txt', 'e'), atomic=True)
+    assert fs.stats()['files_written'] == 3
+    fs.mk(('d/f.txt', 'f'))
+    written = []
+    fs.observer = lambda event: written.append(event.path) if event.op == 'write' else None
+    fs.reset(('a.txt', 'a'), ('b/c.txt', 'c'), ('d/e.txt', 'e'), ('d/f.txt', 'f'))
+    assert written == []
+
+
+# creation journal - cj
+
+def test_cj_undo_only_deletes_what_mk_created(tmpdir):
+    tmpdir.join('keep.txt').write('keep')
+    tmpdir.mkdir('shared').join('keep.txt').write('keep')
+    fs = FilesystemTree(root=str(tmpdir))
+    fs.mk(('shared/new.txt', 'new'), ('a/b/c.txt', 'c'), 'd/e', ('keep.txt', 'overwritten'))
+    fs.undo()
+    assert sorted(os.listdir(str(tmpdir))) == ['keep.txt', 'shared']
+    assert os.listdir(str(tmpdir.join('shared'))) == ['keep.txt']
+    assert tmpdir.join('keep.txt').read() == 'overwritten'
+
+def test_cj_remove_created_only(tmpdir):
+    tmpdir.join('keep.txt').write('keep')
+    fs = FilesystemTree(('a/b.txt', 'b'), root=str(tmpdir))
+    fs.remove(created_only=True)
+    assert os.listdir(str(tmpdir)) == ['keep.txt']
+
+def test_cj_undo_leaves_directories_with_other_things_in_them(tmpdir):
+    fs = FilesystemTree(('a/b.txt', 'b'), root=str(tmpdir))
+    tmpdir.join('a', 'other.txt').write('other')
+    fs.undo()
+    assert os.listdir(str(tmpdir.join('a'))) == ['other.txt']
+
+def test_cj_undo_removes_a_root_the_tree_made():
+    fs = FilesystemTree(('a/b.txt', 'b'))
+    fs.undo()
+    assert not os.path.exists(fs.root)
+
+def test_cj_undo_skips_what_is_already_gone(tmpdir):
+    fs = FilesystemTree(('a/b.txt', 'b'), root=str(tmpdir))
+    FilesystemTree(root=fs.resolve('a')).remove()
+    fs.undo()
+    assert os.listdir(str(tmpdir)) == []
+
+def test_cj_journal_covers_dedup_archives_and_atomic_mk(tmpdir):
+    tmpdir.join('keep.txt').write('keep')
+    fs = FilesystemTree(root=str(tmpdir))
+    fs.mk(('a.txt', 'same'), ('b.txt', 'same'), dedup='hardlink')
+    fs.mk_from_archive(tarball(('c/d.txt', b'd')))
+    fs.mk(('e/f.txt', 'f'), atomic=True)
+    fs.undo()
+    assert os.listdir(fs.root) == ['keep.txt']
+
+def test_cj_journal_starts_over_after_remove(fs):
+    fs.mk(('a.txt', 'a'))
+    fs.remove()
+    fs.mk(('b.txt', 'b'))
+    assert list(fs._journal()) == ['b.txt']
+
+def test_cj_journal_stays_compact_across_resets(fs):
+    for i in range(50):
+        if i % 2:
+            fs.reset(('a/b.txt', 'b'), ('c.txt', 'c'))
+        else:
+            fs.reset(('d.txt', 'd'))
+    assert sorted(fs._journal()) == ['a/', 'a/b.txt', 'c.txt']
+
+def test_cj_undo_after_a_directory_is_made_again(tmpdir):
+    tmpdir.join('x').mkdir()
+    fs = FilesystemTree(('x/f.txt', 'f'), root=str(tmpdir))
+    tmpdir.join('x').remove()
+    fs._forget_dirs()
+    fs.mk(('x/f.txt', 'f'))
+    fs.undo()
+    assert os.listdir(str(tmpdir)) == []
+
+
+# MemoryTree - mt
+
+def test_mt_makes_files_and_dirs():
+    mt = MemoryTree('empty/dir', ('some/dir/file.txt', '    Greetings, program!'))
+    assert mt.tree == {'empty': {'dir': {}}, 'some': {'dir': {'file.txt': b'Greetings, program!'}}}
+
+def test_mt_honors_should_dedent_and_encoding():
+    mt = MemoryTree(encoding='cp1140')
+    mt.mk(('a.txt', '    \x04', 0), ('b.txt', A_UNICODE, 0, 'utf8'))
+    assert mt.read('a.txt') == b'@@@@' + AS_CP1140
+    assert mt.read('b.txt') == AS_UTF8
+
+def test_mt_resolve_uses_root():
+    assert MemoryTree(root='/fixture').resolve('some/dir') == '/fixture/some/dir'
+    assert MemoryTree().resolve() == '/'
+
+def test_mt_listdir_and_stat():
+    mt = MemoryTree('some/dir', ('some/file.txt', 'hello'))
+    assert mt.listdir('some') == ['dir', 'file.txt']
+    assert mt.stat('some/file.txt').st_size == 5
+    assert stat.S_ISDIR(mt.stat('some/dir').st_mode)
+    assert stat.S_ISDIR(mt.stat().st_mode)
+
+def test_mt_walk_is_like_os_walk():
+    mt = MemoryTree(('a/b/c.txt', 'c'), ('a/d.txt', 'd'), 'e')
+    assert list(mt.walk()) == [ ('', ['a', 'e'], [])
+                              , ('a', ['b'], ['d.txt'])
+                              , ('a/b', [], ['c.txt'])
+                              , ('e', [], [])
+                               ]
 
+def test_mt_raises_for_missing_paths():
+    mt = MemoryTree(('file.txt', 'hi'))
+    with pytest.raises(OSError):
+        mt.read('nope.txt')
+    with pytest.raises(OSError):
+        mt.listdir('file.txt')
+    with pytest.raises(OSError):
+        mt.mk(('file.txt/other.txt', 'hi'))
 
+def test_mt_context_manager_removes_on_clean_exit():
+    with MemoryTree(('file.txt', 'hi')) as mt:
+        assert mt.listdir() == ['file.txt']
+    assert mt.tree == {}